@@ -0,0 +1,6 @@
+"""
+mp3bot ~ benchmarks
+Offline benchmarks for the player cog
+
+Copyright (c) 2017 Joshua Butt
+"""
@@ -0,0 +1,317 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ benchmarks/bench.py
+Player subsystem benchmarks
+
+Run from the repository root:
+    python -m benchmarks.bench --size 1000
+    python -m benchmarks.bench --size 1000 --save
+
+Results are compared against benchmarks/baseline.json, exiting with
+status 1 if any result is worse than the baseline by more than the
+tolerance. Everything runs offline against a generated library.
+Saving keeps the baseline of benchmarks which were skipped, so the
+Opus benchmarks should be saved on a host with libopus.
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import argparse
+import asyncio
+import ctypes.util
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import discord
+
+from cogs.player import catalog, search
+from cogs.player.config import ENCODER_COMPLEXITY, ENCODER_MIN_COMPLEXITY
+from cogs.player.encoder import configure_encoder
+from cogs.player.player import Playlist
+from cogs.player.source import CrossfadeMixer, SessionSource
+from cogs.player.track import ClypTrack, Mp3File, YoutubeVideo
+
+from .library import generate_library
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(__file__), "fixtures")
+
+LOWER = "lower"
+HIGHER = "higher"
+
+log = logging.getLogger("benchmarks")
+log.setLevel(logging.CRITICAL)
+
+
+class Requester:
+    """Stand-in for a :class:`discord.Member`"""
+    name = "benchmark"
+    avatar_url = ""
+
+
+def timed(function, repeat):
+    """Returns the median time taken by ``function`` over ``repeat`` runs"""
+    timings = list()
+    for run in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def bench_playlist(directory, size):
+    results = dict()
+
+    directory = os.path.realpath(directory)
+    file = catalog.catalog_file(directory)
+
+    def build_from_scratch():
+        if os.path.isfile(file):
+            os.remove(file)
+        catalog.build_catalog(directory, file)
+
+    results["catalog_build_seconds"] = (timed(build_from_scratch, 3), LOWER)
+    # with an up to date catalog to reuse tags from, as when files are added
+    results["catalog_rebuild_seconds"] = (timed(
+        lambda: catalog.build_catalog(directory, file), 3), LOWER)
+
+    results["playlist_construction_seconds"] = (timed(
+        lambda: Playlist(log, catalog.open_catalog(directory), playlist_directory=directory), 5), LOWER)
+
+    library = catalog.open_catalog(directory)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    playlists = [Playlist(log, library, playlist_directory=directory, cache_length=1) for playlist in range(10)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    results["playlist_bytes_per_instance"] = (sum(
+        stat.size_diff for stat in after.compare_to(before, "filename")) / len(playlists), LOWER)
+
+    playlist = Playlist(log, library, playlist_directory=directory)
+    calls = min(size, 200)
+    elapsed = timed(lambda: [playlist.next_track for call in range(calls)], 3)
+    results["playlist_next_track_per_second"] = (calls / elapsed, HIGHER)
+
+    return results
+
+
+def bench_search(directory, files, sizes):
+    results = dict()
+    loop = asyncio.new_event_loop()
+    rng = random.Random(0)
+    queries = [os.path.basename(file)[7:-4] for file in rng.sample(files, 20)]
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as subset:
+            # link a subset of the library so each size is searched independently
+            for file in files[:size]:
+                os.symlink(file, os.path.join(subset, os.path.basename(file)))
+
+            search.DEFAULT_PLAYLIST_DIRECTORY = subset
+            elapsed = timed(lambda: [loop.run_until_complete(search.Mp3FileSearch(
+                log, query, Requester()).get()) for query in queries], 3)
+            results[f"mp3_search_{size}_tracks_seconds"] = (
+                elapsed / len(queries), LOWER)
+
+    search.DEFAULT_PLAYLIST_DIRECTORY = directory
+    loop.close()
+
+    library = catalog.open_catalog(directory)
+    prefixes = [query[:length] for query in queries for length in (2, 4, 8)]
+    elapsed = timed(lambda: [library.complete(prefix) for prefix in prefixes], 3)
+    results["catalog_complete_per_second"] = (len(prefixes) / elapsed, HIGHER)
+    return results
+
+
+def allocated_per_instance(function, count):
+    """Returns the bytes allocated per object by ``count`` calls of ``function``"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [function(index) for index in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename")) / len(objects)
+
+
+def bench_mp3file(files):
+    results = dict()
+    sample = files[:200]
+
+    results["mp3file_load_seconds"] = (timed(
+        lambda: [Mp3File(log, file) for file in sample], 3) / len(sample), LOWER)
+
+    results["mp3file_bytes_per_instance"] = (allocated_per_instance(
+        lambda index: Mp3File(log, sample[index]), len(sample)), LOWER)
+    return results
+
+
+def bench_remote_tracks():
+    with open(os.path.join(FIXTURES_DIRECTORY, "youtube_videos.json")) as fixture:
+        videos = [json.dumps(video) for video in json.load(fixture)["items"]]
+    with open(os.path.join(FIXTURES_DIRECTORY, "clyp_track.json")) as fixture:
+        clyp_track = fixture.read()
+    requester = Requester()
+
+    # responses are decoded while measuring, so whatever a track keeps of them is counted
+    return {
+        "youtube_video_bytes_per_instance": (allocated_per_instance(
+            lambda index: YoutubeVideo(log, json.loads(videos[index % len(videos)]), requester), 1000), LOWER),
+        "clyp_track_bytes_per_instance": (allocated_per_instance(
+            lambda index: ClypTrack(log, json.loads(clyp_track), requester), 1000), LOWER)
+    }
+
+
+def bench_embeds(files):
+    sample = [Mp3File(log, file, requester=Requester()) for file in files[:20]]
+
+    def run():
+        for track in sample:
+            track.playing_embed
+            track.queue
+
+    # the first pass renders every embed, later passes reuse them
+    return {"mp3file_embed_seconds": (timed(run, 5) / len(sample), LOWER)}
+
+
+def bench_volume(seconds):
+    frame_size = discord.opus.Encoder.FRAME_SIZE
+    frames = int(seconds * 50)
+    pcm = random.Random(0).getrandbits(frame_size * 8 * 50).to_bytes(
+        frame_size * 50, "little") * (frames // 50 + 1)
+
+    def run():
+        source = SessionSource(discord.PCMAudio(io.BytesIO(pcm)), 0.15)
+        for frame in range(frames):
+            source.read()
+
+    return {"pcm_volume_frames_per_second": (frames / timed(run, 3), HIGHER)}
+
+
+def bench_encoder(seconds):
+    """Skipped if libopus can't be found"""
+    if not discord.opus.is_loaded():
+        if ctypes.util.find_library("opus") is None:
+            return dict()
+        discord.opus.load_opus(ctypes.util.find_library("opus"))
+
+    frame_size = discord.opus.Encoder.FRAME_SIZE
+    frames = int(seconds * 50)
+    pcm = random.Random(2).getrandbits(frame_size * 8 * 50).to_bytes(
+        frame_size * 50, "little")
+
+    results = dict()
+    for complexity in (ENCODER_COMPLEXITY, ENCODER_MIN_COMPLEXITY):
+        encoder = discord.opus.Encoder()
+        configure_encoder(encoder, 64, complexity)
+
+        def run():
+            for frame in range(frames):
+                encoder.encode(pcm[frame % 50 * frame_size:(frame % 50 + 1) * frame_size],
+                               encoder.SAMPLES_PER_FRAME)
+
+        results[f"opus_complexity_{complexity}_frames_per_second"] = (
+            frames / timed(run, 3), HIGHER)
+    return results
+
+
+def bench_crossfade(seconds):
+    frame_size = discord.opus.Encoder.FRAME_SIZE
+    frames = int(seconds * 50)
+    pcm = random.Random(1).getrandbits(frame_size * 8 * 50).to_bytes(
+        frame_size * 50, "little") * (frames // 50 + 1)
+
+    # times only the reads which mix the two tracks
+    timings = list()
+    for run in range(3):
+        mixer = CrossfadeMixer(discord.PCMAudio(
+            io.BytesIO(pcm)), seconds=seconds)
+        mixer.offer(discord.PCMAudio(io.BytesIO(pcm)),
+                    check=lambda: True, started=lambda: None)
+        mixed, elapsed = 0, 0
+        while True:
+            fading = mixer.fading
+            started = time.perf_counter()
+            if not mixer.read():
+                break
+            if fading:
+                elapsed += time.perf_counter() - started
+                mixed += 1
+        timings.append(mixed / elapsed)
+
+    return {"crossfade_frames_per_second": (statistics.median(timings), HIGHER)}
+
+
+def compare(results, baseline, tolerance):
+    """Prints results against a baseline, returning True if any regressed"""
+    regressed = False
+    print(f"{'benchmark':<40}{'result':>16}{'baseline':>16}{'change':>10}")
+    for name, (value, better) in sorted(results.items()):
+        base = baseline.get(name, {}).get("value", None)
+        if base:
+            change = (value - base) / base
+            worse = change > tolerance if better == LOWER else change < -tolerance
+            regressed |= worse
+            print(f"{name:<40}{value:>16.6g}{base:>16.6g}{change:>+10.1%}{'  REGRESSED' if worse else ''}")
+        else:
+            print(f"{name:<40}{value:>16.6g}{'-':>16}{'-':>10}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=1000,
+                        help="number of tracks in the generated library")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--library", default=None,
+                        help="directory to generate the library in, reused between runs")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative change allowed before a result counts as a regression")
+    args = parser.parse_args()
+
+    directory = args.library or os.path.join(
+        tempfile.gettempdir(), f"mp3bot-bench-{args.size}-{args.seed}")
+    files = generate_library(directory, args.size, seed=args.seed)
+    catalog.CATALOG_DIRECTORY = os.path.join(tempfile.gettempdir(), "mp3bot-catalog")
+    sizes = sorted({size for size in (100, 1000, args.size) if size <= args.size})
+
+    results = dict()
+    results.update(bench_playlist(directory, args.size))
+    results.update(bench_search(directory, files, sizes))
+    results.update(bench_mp3file(files))
+    results.update(bench_remote_tracks())
+    results.update(bench_embeds(files))
+    results.update(bench_volume(10))
+    results.update(bench_crossfade(3))
+    results.update(bench_encoder(10))
+
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressed = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        # benchmarks skipped on this host, such as those needing libopus, keep their saved results
+        baseline.update({name: {"value": value, "better": better} for name, (value, better) in results.items()})
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(dict(sorted(baseline.items())), baseline_file, indent=4)
+        print(f"Saved baseline to {args.baseline}")
+    elif regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ benchmarks/fakes.py
+Offline stand-ins for the Discord gateway, REST API and voice
+
+Only the parts of discord.py used by the player cog are implemented.
+REST calls sleep for a configurable latency, gateway events are
+dispatched directly by :meth:`FakeBot.dispatch` and voice clients
+consume audio in real time on their own thread without sending it.
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+
+import discord
+
+__all__ = [
+    "FakeBot",
+    "FakeContext",
+    "FakeGuild",
+    "FakeMember",
+    "FakeReaction",
+    "NullVoiceClient"
+]
+
+_ids = itertools.count(1000)
+
+
+class FakeVoiceState:
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.deaf = False
+        self.self_deaf = False
+        self.mute = False
+
+
+class FakeMember:
+
+    def __init__(self, guild, name, *, bot=False):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.bot = bot
+        self.avatar_url = ""
+        self.roles = list()
+        self.voice = None
+        self.guild_permissions = discord.Permissions.none()
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+
+    def __init__(self, channel, author, *, content="", embed=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.reactions = list()
+
+    async def add_reaction(self, emoji):
+        await self.channel.rest()
+        self.reactions.append(emoji)
+
+    async def delete(self):
+        await self.channel.rest()
+
+
+class FakeReaction:
+
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+
+
+class FakeTextChannel:
+    """Text channel whose REST calls take ``latency`` seconds"""
+
+    def __init__(self, guild, bot, name, *, latency=0.05):
+        self.id = next(_ids)
+        self.guild = guild
+        self.bot = bot
+        self.name = name
+        self.latency = latency
+        self.messages = 0
+        self.on_send = None
+
+    async def rest(self):
+        self.bot.rest_calls += 1
+        await asyncio.sleep(self.latency)
+
+    async def send(self, content=None, *, embed=None, file=None, **kwargs):
+        await self.rest()
+        self.messages += 1
+        message = FakeMessage(self, self.bot.user,
+                              content=content or "", embed=embed)
+        if self.on_send is not None:
+            self.on_send(message)
+        return message
+
+    async def trigger_typing(self):
+        await self.rest()
+
+    def __str__(self):
+        return self.name
+
+
+class FakeVoiceChannel:
+
+    def __init__(self, guild, bot, name, *, bitrate=64000):
+        self.id = next(_ids)
+        self.guild = guild
+        self.bot = bot
+        self.name = name
+        self.bitrate = bitrate
+        self.members = list()
+
+    async def connect(self, *, timeout=60, reconnect=True):
+        await asyncio.sleep(self.bot.voice_latency)
+        self.guild.me.voice = FakeVoiceState(self)
+        self.members.append(self.guild.me)
+        return NullVoiceClient(self.bot, self)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    """Guild with one voice channel, one text channel and some listeners"""
+
+    def __init__(self, bot, name, *, listeners=5, latency=0.05):
+        self.id = next(_ids)
+        self.name = name
+        self.roles = list()
+
+        self.me = FakeMember(self, bot.user.name, bot=True)
+        self.voice_channel = FakeVoiceChannel(self, bot, f"{name}-voice")
+        self.text_channel = FakeTextChannel(
+            self, bot, f"{name}-text", latency=latency)
+
+        self.listeners = list()
+        for index in range(listeners):
+            member = FakeMember(self, f"{name}-listener-{index}")
+            member.voice = FakeVoiceState(self.voice_channel)
+            self.voice_channel.members.append(member)
+            self.listeners.append(member)
+
+    def __str__(self):
+        return self.name
+
+
+class NullAudioPlayer(threading.Thread):
+    """Reads a source every 20ms like discord.py's AudioPlayer, discarding the frames"""
+
+    DELAY = 0.02
+
+    def __init__(self, client, source, after):
+        super().__init__(daemon=True)
+        self.client = client
+        self.source = source
+        self.after = after
+
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+
+    def run(self):
+        error = None
+        try:
+            loops = 0
+            start = time.perf_counter()
+            while not self._end.is_set():
+                if not self._resumed.is_set():
+                    self._resumed.wait()
+                    loops = 0
+                    start = time.perf_counter()
+                    continue
+
+                loops += 1
+                data = self.source.read()
+                if not data:
+                    break
+
+                self.client.frames += 1
+                next_time = start + self.DELAY * loops
+                delay = next_time - time.perf_counter()
+                if delay < 0:
+                    self.client.late_frames += 1
+                time.sleep(max(0, delay))
+        except Exception as e:
+            error = e
+        finally:
+            self._end.set()  # as discord.py does, so after may start the next source
+            self.source.cleanup()
+            if self.after is not None:
+                self.after(error)
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+
+class NullVoiceClient:
+    """Voice client which consumes audio in real time without sending it"""
+
+    def __init__(self, bot, channel):
+        self.bot = bot
+        self.loop = bot.loop
+        self.channel = channel
+        self.guild = channel.guild
+
+        self.encoder = None
+        self.frames = 0
+        self.late_frames = 0
+
+        self._player = None
+        self._connected = True
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value):
+        if self._player is None:
+            raise ValueError("Not playing anything.")
+        self._player.source = value
+
+    def is_connected(self):
+        return self._connected
+
+    def play(self, source, *, after=None):
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        if not source.is_opus() and discord.opus.is_loaded():
+            self.encoder = discord.opus.Encoder()  # as discord.py makes one on first use
+        self._player = NullAudioPlayer(self, source, after)
+        self._player.start()
+
+    def is_playing(self):
+        return self._player is not None and not self._player._end.is_set() and self._player._resumed.is_set()
+
+    def is_paused(self):
+        return self._player is not None and not self._player._end.is_set() and not self._player._resumed.is_set()
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+
+    def pause(self):
+        if self._player:
+            self._player.pause()
+
+    def resume(self):
+        if self._player:
+            self._player.resume()
+
+    async def disconnect(self, *, force=False):
+        if not force and not self._connected:
+            return
+        self.stop()
+        self._connected = False
+        if self.guild.me in self.channel.members:
+            self.channel.members.remove(self.guild.me)
+
+
+class FakeCommand:
+
+    def __init__(self, name):
+        self.name = name
+        self.checks = list()
+
+
+class FakeContext:
+    """Command context for a member in a guild's text channel"""
+
+    def __init__(self, bot, cog, member, command):
+        self.bot = bot
+        self.cog = cog
+        self.guild = member.guild
+        self.author = member
+        self.channel = member.guild.text_channel
+        self.message = FakeMessage(self.channel, member)
+        self.prefix = "!;"
+        self.command = FakeCommand(command)
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    async def trigger_typing(self):
+        await self.channel.trigger_typing()
+
+
+class FakeBot:
+    """Bot with an in-process gateway
+
+    :meth:`dispatch` delivers events to :meth:`wait_for` listeners in
+    the same way the real gateway does.
+    """
+
+    def __init__(self, loop, log, *, voice_latency=0.2):
+        self.loop = loop
+        self.log = log
+        self.voice_latency = voice_latency
+        self.owner_id = 0
+        self.rest_calls = 0
+
+        self.user = FakeMember(None, "mp3bot", bot=True)
+        self.guilds = list()
+        self._listeners = dict()
+
+    def get_channel(self, channel_id):
+        for guild in self.guilds:
+            for channel in (guild.voice_channel, guild.text_channel):
+                if channel.id == channel_id:
+                    return channel
+        return None
+
+    def dispatch(self, event, *args):
+        listeners = self._listeners.get(event, list())
+        for future, check in list(listeners):
+            if future.cancelled():
+                listeners.remove((future, check))
+                continue
+            try:
+                if check(*args):
+                    future.set_result(args[0] if len(args) == 1 else args)
+                    listeners.remove((future, check))
+            except Exception as e:
+                future.set_exception(e)
+                listeners.remove((future, check))
+
+    def wait_for(self, event, *, check=None, timeout=None):
+        future = self.loop.create_future()
+        self._listeners.setdefault(event, list()).append(
+            (future, check or (lambda *args: True)))
+        return asyncio.wait_for(future, timeout)
@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ benchmarks/library.py
+Synthetic MP3 library generator
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import os
+import random
+import struct
+import zlib
+
+from mutagen.id3 import APIC, ID3, TALB, TDRC, TIT2, TPE1
+
+__all__ = [
+    "generate_library"
+]
+
+# MPEG-1 Layer III, 128kbps, 44.1kHz, joint stereo
+FRAME_HEADER = b"\xff\xfb\x90\x64"
+FRAME_LENGTH = 417
+FRAMES_PER_SECOND = 44100 / 1152
+
+# Covers are this image padded with a random private chunk so every track's cover differs
+COVER_TEMPLATE = os.path.join(os.path.dirname(
+    __file__), os.pardir, "lib", "img", "art_not_found.png")
+
+WORDS = [
+    "midnight", "river", "echo", "golden", "static", "summer", "neon", "ghost",
+    "paper", "hearts", "electric", "ocean", "silver", "city", "lights", "fire",
+    "dream", "shadow", "velvet", "thunder", "crystal", "wild", "northern", "sky",
+    "café", "señorita", "über", "naïve", "東京", "夜明け", "сердце", "ψυχή"
+]
+
+
+def _phrase(rng, words):
+    return " ".join(rng.choice(WORDS) for word in range(words)).title()
+
+
+def _cover(template, padding):
+    # insert an ancillary chunk before IEND, which image decoders skip
+    chunk = b"rnDm" + padding
+    chunk = struct.pack(">I", len(padding)) + chunk + \
+        struct.pack(">I", zlib.crc32(chunk) & 0xffffffff)
+    return template[:-12] + chunk + template[-12:]
+
+
+def _audio(seconds):
+    frame = FRAME_HEADER + bytes(FRAME_LENGTH - len(FRAME_HEADER))
+    return frame * max(1, int(seconds * FRAMES_PER_SECOND))
+
+
+def generate_library(directory, size, *, seed=0, seconds=1, cover_size=16 * 1024, missing_tags=0.1):
+    """Writes ``size`` MP3 files with random ID3 tags and covers to a directory
+
+    A fraction of files, given by ``missing_tags``, are left without some
+    tags or a cover so that fallback paths are exercised as well. Returns
+    the list of file paths. Files already present are reused.
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    audio = _audio(seconds)
+    with open(COVER_TEMPLATE, "rb") as template_file:
+        template = template_file.read()
+
+    files = list()
+    for index in range(size):
+        artist = _phrase(rng, rng.randint(1, 2))
+        title = _phrase(rng, rng.randint(1, 4))
+        album = _phrase(rng, rng.randint(1, 3))
+        year = str(rng.randint(1960, 2017))
+        cover = _cover(template, rng.getrandbits(cover_size * 8).to_bytes(
+            cover_size, "little")) if rng.random() >= missing_tags else None
+        drop_tags = rng.random() < missing_tags
+
+        file = os.path.join(directory, f"{index:06d} {artist} - {title}.mp3")
+        files.append(file)
+        if os.path.exists(file):
+            continue
+
+        with open(file, "wb") as mp3_file:
+            mp3_file.write(audio)
+
+        tags = ID3()
+        tags.add(TIT2(encoding=3, text=title))
+        if not drop_tags:
+            tags.add(TPE1(encoding=3, text=artist))
+            tags.add(TALB(encoding=3, text=album))
+            tags.add(TDRC(encoding=3, text=year))
+        if cover is not None:
+            tags.add(APIC(encoding=3, mime="image/png",
+                          type=3, desc="", data=cover))
+        tags.save(file)
+
+    return files
@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ benchmarks/loadtest.py
+Offline load test of the player cog
+
+Drives the real Player cog against fake guilds, each with a session
+playing from a generated library, scripted request, skip, repeat, queue,
+volume and restart commands, listeners deafening and undeafening and
+dropped voice connections. Reports CPU, memory, event loop lag, audio
+underruns and voice reconnect times for each guild count.
+
+Run from the repository root (ffmpeg must be installed):
+    python -m benchmarks.loadtest --guilds 1 10 50 --duration 60
+    python -m benchmarks.loadtest --guilds 1 10 50 --duration 60 --audio-workers 4
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import cogs.player
+
+from cogs.player import Player, catalog, search
+from cogs.player.player import Session, voice_reconnect_time
+from cogs.player.search import Mp3FileSearch
+from cogs.utils.watchdog import LagMonitor
+
+from .fakes import FakeBot, FakeContext, FakeGuild, FakeReaction
+from .library import generate_library
+
+log = logging.getLogger("loadtest")
+
+# Relative weights of scripted listener actions
+ACTIONS = {
+    "request": 3,
+    "skip": 2,
+    "repeat": 1,
+    "queue": 2,
+    "volume": 2,
+    "deafen": 4,
+    "restart": 0.5,
+    "drop": 0.5
+}
+
+SELECTION_EMOJI = "1⃣"
+
+
+def rss():
+    """Returns the resident memory of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def drive_guild(bot, cog, guild, queries, rng, *, rate, until):
+    """Sends scripted commands and voice state changes for one guild"""
+    errors = 0
+
+    def select_result(message):
+        # the requester picks the first result after a short think
+        if message.embed is not None and str(message.embed.title).startswith("Results for search"):
+            bot.loop.call_later(rng.uniform(0.1, 1), bot.dispatch, "reaction_add",
+                                FakeReaction(message, SELECTION_EMOJI), guild.requester)
+    guild.text_channel.on_send = select_result
+
+    while time.monotonic() < until:
+        await asyncio.sleep(rng.expovariate(rate))
+
+        action = rng.choices(list(ACTIONS), weights=list(ACTIONS.values()))[0]
+        member = rng.choice(guild.listeners)
+        ctx = FakeContext(bot, cog, member, action)
+
+        try:
+            if action == "request":
+                guild.requester = member
+                await cog.player_request.callback(cog, ctx, Mp3FileSearch, query=rng.choice(queries))
+            elif action == "skip":
+                await cog.player_skip_track.callback(cog, ctx)
+            elif action == "repeat":
+                await cog.player_repeat_track.callback(cog, ctx)
+            elif action == "queue":
+                await cog.player_get_queue.callback(cog, ctx)
+            elif action == "volume":
+                await cog.player_set_volume.callback(cog, ctx, round(rng.uniform(0.05, 0.5), 2))
+            elif action == "deafen":
+                member.voice.self_deaf = not member.voice.self_deaf
+                await cog.on_voice_state_update(member, member.voice, member.voice)
+            elif action == "restart":
+                await cog.player_restart_session.callback(cog, ctx)
+            elif action == "drop":
+                # as discord.py does once it gives up reconnecting the voice websocket
+                await cog.sessions[guild.id].voice.disconnect(force=True)
+        except Exception as e:
+            log.debug(f"{action} failed: {type(e).__name__}: {e}")
+            errors += 1
+
+    return errors
+
+
+async def run(guild_count, args, library, queries):
+    """Runs the load test for a number of guilds, returning a dict of results"""
+    loop = asyncio.get_event_loop()
+    bot = FakeBot(loop, log)
+    cog = Player(bot)
+    monitor = LagMonitor(loop, log)
+    monitor.start()
+
+    for index in range(guild_count):
+        guild = FakeGuild(bot, f"guild-{index}", listeners=args.listeners, latency=args.rest_latency)
+        bot.guilds.append(guild)
+
+        voice = await guild.voice_channel.connect()
+        cog.sessions[guild.id] = Session(bot, cog, voice, guild.text_channel,
+                                         playlist=await cog._open_playlist(playlist_directory=library))
+
+    rng = random.Random(args.seed)
+    cpu, wall = time.process_time(), time.monotonic()
+    until = wall + args.duration
+
+    errors = await asyncio.gather(*(drive_guild(bot, cog, guild, queries, random.Random(rng.random()),
+                                                rate=args.rate, until=until) for guild in bot.guilds))
+
+    cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+    sessions = list(cog.sessions.values())
+    results = {
+        "guilds": guild_count,
+        "cpu": 100 * cpu / wall,
+        "rss": rss() / 1024 / 1024,
+        "lag": monitor.max_lag * 1000,
+        "stalls": len(monitor.stalls),
+        "frames": sum(session.voice.frames for session in sessions),
+        "underruns": sum(session.frame_stats.underruns for session in sessions),
+        "late": sum(session.voice.late_frames for session in sessions),
+        "errors": sum(errors),
+        "rest": bot.rest_calls,
+        "reconnect": 1000 * max(voice_reconnect_time.quantile(0.99, result) or 0
+                                for result in ("resumed", "reopened"))
+    }
+
+    for session in sessions:
+        session.stop()
+    await asyncio.sleep(1)
+    cog.transcoders.stop()
+    if cog.audio_workers is not None:
+        cog.audio_workers.stop()
+    monitor.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--duration", type=float, default=60,
+                        help="seconds to run each guild count for")
+    parser.add_argument("--rate", type=float, default=0.2,
+                        help="scripted actions per second per guild")
+    parser.add_argument("--listeners", type=int, default=5)
+    parser.add_argument("--rest-latency", type=float, default=0.05)
+    parser.add_argument("--size", type=int, default=200,
+                        help="number of tracks in the generated library")
+    parser.add_argument("--track-seconds", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--audio-workers", type=int, default=0,
+                        help="audio worker processes, 0 to produce audio in this process")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg must be installed to run the load test")
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    library = os.path.join(tempfile.gettempdir(
+    ), f"mp3bot-loadtest-{args.size}-{args.track_seconds:g}-{args.seed}")
+    files = generate_library(library, args.size, seed=args.seed, seconds=args.track_seconds)
+    queries = [os.path.basename(file)[7:-4] for file in files]
+    search.DEFAULT_PLAYLIST_DIRECTORY = library
+    cogs.player.DEFAULT_PLAYLIST_DIRECTORY = library
+    catalog.CATALOG_DIRECTORY = os.path.join(tempfile.gettempdir(), "mp3bot-catalog")
+    cogs.player.AUDIO_WORKERS = args.audio_workers
+
+    print(f"{'guilds':>7}{'cpu %':>8}{'rss MiB':>9}{'lag ms':>8}{'stalls':>8}{'frames':>9}{'underruns':>11}{'late':>7}{'errors':>8}{'rest':>7}{'reconnect p99 ms':>18}")
+    loop = asyncio.get_event_loop()
+    for guild_count in args.guilds:
+        results = loop.run_until_complete(run(guild_count, args, library, queries))
+        print("{guilds:>7}{cpu:>8.1f}{rss:>9.1f}{lag:>8.1f}{stalls:>8}{frames:>9}{underruns:>11}{late:>7}{errors:>8}{rest:>7}{reconnect:>18.0f}".format(**results))
+
+
+if __name__ == "__main__":
+    main()
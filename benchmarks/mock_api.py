@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ benchmarks/mock_api.py
+Local mock servers for the YouTube Data API and Clyp
+
+Replays the recorded responses in benchmarks/fixtures with configurable
+latency, error rate and YouTube quota. Point the bot at it with:
+    MP3BOT_YOUTUBE_API_URL=http://127.0.0.1:8765
+    MP3BOT_CLYP_API_URL=http://127.0.0.1:8765/clyp
+
+Run from the repository root:
+    python -m benchmarks.mock_api --latency 0.15 --error-rate 0.01 --quota 10000
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+
+from aiohttp import web
+
+__all__ = [
+    "MockAPI"
+]
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# Quota units charged by the YouTube Data API per call
+QUOTA_COST = {
+    "search": 100,
+    "videos": 1
+}
+
+
+def _fixture(name):
+    with open(os.path.join(FIXTURES_DIRECTORY, f"{name}.json"), encoding="utf-8") as fixture:
+        return json.load(fixture)
+
+
+class MockAPI:
+    """YouTube Data API and Clyp mock server
+
+    Every request waits ``latency`` seconds, plus or minus ``jitter``,
+    fails with a 500 with probability ``error_rate`` and, for YouTube,
+    fails with a quotaExceeded 403 once ``quota`` units have been used.
+    Request counts are served as JSON from ``/_stats``.
+    """
+
+    def __init__(self, *, latency=0.1, jitter=0.02, error_rate=0, quota=None, seed=0):
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota = quota
+
+        self.rng = random.Random(seed)
+        self.search = _fixture("youtube_search")
+        self.videos = {video["id"]: video for video in _fixture("youtube_videos")["items"]}
+        self.quota_exceeded = _fixture("youtube_quota_exceeded")
+        self.clyp_track = _fixture("clyp_track")
+
+        self.runner = None
+        self.reset()
+
+    def reset(self):
+        """Resets request counts and quota usage"""
+        self.requests = {"search": 0, "videos": 0, "clyp": 0}
+        self.failures = {"error": 0, "quota": 0, "not_found": 0}
+        self.quota_used = 0
+
+    @property
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/youtube/v3/search", self._handle_search)
+        app.router.add_get("/youtube/v3/videos", self._handle_videos)
+        app.router.add_get("/clyp/{track_id}", self._handle_clyp)
+        app.router.add_get("/_stats", self._handle_stats)
+        app.router.add_post("/_reset", self._handle_reset)
+        return app
+
+    async def start(self, host="127.0.0.1", port=8765):
+        """Starts serving in the running event loop"""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def _simulate(self, endpoint):
+        """Counts, delays and possibly fails a request, returning an error response or None"""
+        self.requests[endpoint] += 1
+        await asyncio.sleep(max(0, self.rng.gauss(self.latency, self.jitter)))
+
+        if self.rng.random() < self.error_rate:
+            self.failures["error"] += 1
+            return web.json_response({"error": {"code": 500, "message": "Backend Error"}}, status=500)
+
+        if endpoint in QUOTA_COST and self.quota is not None:
+            if self.quota_used + QUOTA_COST[endpoint] > self.quota:
+                self.failures["quota"] += 1
+                return web.json_response(self.quota_exceeded, status=403)
+            self.quota_used += QUOTA_COST[endpoint]
+
+        return None
+
+    async def _handle_search(self, request):
+        error = await self._simulate("search")
+        if error is not None:
+            return error
+        return web.json_response(self.search)
+
+    async def _handle_videos(self, request):
+        error = await self._simulate("videos")
+        if error is not None:
+            return error
+
+        items = list()
+        template = next(iter(self.videos.values()))
+        for video_id in filter(None, request.query.get("id", "").split(",")):
+            video = self.videos.get(video_id, None)
+            if video is None:
+                # unrecorded IDs get a copy of the first recording
+                video = copy.deepcopy(template)
+                video["id"] = video_id
+                video["snippet"]["title"] = f"Synthetic Video {video_id}"
+            items.append(video)
+
+        return web.json_response({"kind": "youtube#videoListResponse", "items": items})
+
+    async def _handle_clyp(self, request):
+        error = await self._simulate("clyp")
+        if error is not None:
+            return error
+
+        track_id = request.match_info["track_id"]
+        if track_id.startswith("missing"):
+            self.failures["not_found"] += 1
+            return web.json_response({"Message": "Not found"}, status=404)
+
+        track = dict(self.clyp_track)
+        track["AudioFileId"] = track_id
+        track["Url"] = f"https://clyp.it/{track_id}"
+        return web.json_response(track)
+
+    async def _handle_stats(self, request):
+        return web.json_response({
+            "requests": self.requests,
+            "failures": self.failures,
+            "quota_used": self.quota_used
+        })
+
+    async def _handle_reset(self, request):
+        self.reset()
+        return web.json_response({})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--quota", type=int, default=None,
+                        help="YouTube quota units available before quotaExceeded errors")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    mock = MockAPI(latency=args.latency, jitter=args.jitter,
+                   error_rate=args.error_rate, quota=args.quota, seed=args.seed)
+    print(f"Serving YouTube at http://{args.host}:{args.port} and Clyp at http://{args.host}:{args.port}/clyp")
+    web.run_app(mock.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
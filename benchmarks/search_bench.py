@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ benchmarks/search_bench.py
+YouTube and Clyp search benchmarks against the local mock API
+
+Each scenario fires a burst of concurrent searches at an in-process
+mock server and reports latency percentiles, failures and how many
+requests actually reached the upstream API, so coalescing and caching
+can be measured offline. Outage scenarios then send waves of searches
+while the API fails every request.
+
+Run from the repository root:
+    python -m benchmarks.search_bench --concurrency 50 --latency 0.2
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+
+from cogs.player import resilience, search
+from cogs.player.search import ClypSearch, SearchError, YoutubeSearch
+
+from .mock_api import MockAPI
+
+log = logging.getLogger("benchmarks")
+log.setLevel(logging.CRITICAL)
+
+
+class Requester:
+    """Stand-in for a :class:`discord.Member`"""
+    name = "benchmark"
+    avatar_url = ""
+
+
+# Scenario name, search type and a function returning the query for each request
+SCENARIOS = [
+    ("youtube identical", YoutubeSearch, lambda index: "northern lights"),
+    ("youtube distinct", YoutubeSearch, lambda index: f"northern lights {index}"),
+    ("youtube video url", YoutubeSearch, lambda index: "https://youtu.be/mockVideo01"),
+    ("clyp identical", ClypSearch, lambda index: "mock0001"),
+    ("clyp distinct", ClypSearch, lambda index: f"mock{index:04d}"),
+    ("clyp not found", ClypSearch, lambda index: "missing1")
+]
+
+# Scenario name, search type, query function and mock API settings for the outage
+OUTAGES = [
+    ("youtube server errors", YoutubeSearch, lambda index: f"outage {index}", {"error_rate": 1}),
+    ("youtube quota", YoutubeSearch, lambda index: f"quota {index}", {"quota": 0}),
+    ("clyp server errors", ClypSearch, lambda index: f"down{index:04d}", {"error_rate": 1})
+]
+
+
+async def run_scenario(mock, search_type, query, concurrency):
+    """Runs ``concurrency`` searches at once, returning latencies, failures and upstream requests"""
+    mock.reset()
+
+    async def timed_search(index):
+        started = time.perf_counter()
+        try:
+            await search_type(log, query(index), Requester()).get()
+            failed = False
+        except SearchError:
+            failed = True
+        return time.perf_counter() - started, failed
+
+    results = await asyncio.gather(*(timed_search(index) for index in range(concurrency)))
+    latencies = sorted(latency for latency, failed in results)
+    return {
+        "latencies": latencies,
+        "p50": statistics.median(latencies) * 1000,
+        "p95": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+        "max": latencies[-1] * 1000,
+        "failed": sum(failed for latency, failed in results),
+        "upstream": sum(mock.requests.values())
+    }
+
+
+async def run_outage(mock, search_type, query, settings, args):
+    """Runs waves of searches while the mock API fails, returning the same results as :func:`run_scenario`"""
+    for upstream in resilience.upstreams:
+        upstream.reset()
+    saved = {name: getattr(mock, name) for name in settings}
+    for name, value in settings.items():
+        setattr(mock, name, value)
+
+    requests = 0
+    latencies, failed, upstream = list(), 0, 0
+    per_wave = max(args.concurrency // args.waves, 1)
+    for wave in range(args.waves):
+        results = await run_scenario(mock, search_type,
+                                     lambda index: query(requests + index), per_wave)
+        requests += per_wave
+        latencies.extend(results.pop("latencies"))
+        failed += results["failed"]
+        upstream += results["upstream"]
+        await asyncio.sleep(args.wave_interval)
+
+    for name, value in saved.items():
+        setattr(mock, name, value)
+    latencies.sort()
+    return {
+        "requests": requests,
+        "p50": statistics.median(latencies) * 1000,
+        "p95": latencies[int(0.95 * (len(latencies) - 1))] * 1000,
+        "max": latencies[-1] * 1000,
+        "failed": failed,
+        "upstream": upstream
+    }
+
+
+async def run(args):
+    mock = MockAPI(latency=args.latency, jitter=args.jitter,
+                   error_rate=args.error_rate, quota=args.quota, seed=args.seed)
+    await mock.start(port=args.port)
+
+    search.YOUTUBE_API_URL = f"http://127.0.0.1:{args.port}"
+    search.CLYP_API_URL = f"http://127.0.0.1:{args.port}/clyp"
+
+    print(f"{'scenario':<22}{'requests':>10}{'upstream':>10}{'failed':>8}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+    for name, search_type, query in SCENARIOS:
+        results = await run_scenario(mock, search_type, query, args.concurrency)
+        print(f"{name:<22}{args.concurrency:>10}{results['upstream']:>10}{results['failed']:>8}"
+              f"{results['p50']:>9.1f}{results['p95']:>9.1f}{results['max']:>9.1f}")
+
+    for name, search_type, query, settings in OUTAGES:
+        results = await run_outage(mock, search_type, query, settings, args)
+        print(f"{name:<22}{results['requests']:>10}{results['upstream']:>10}{results['failed']:>8}"
+              f"{results['p50']:>9.1f}{results['p95']:>9.1f}{results['max']:>9.1f}")
+
+    await mock.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="searches fired at once in each scenario")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--quota", type=int, default=None,
+                        help="YouTube quota units available before quotaExceeded errors")
+    parser.add_argument("--waves", type=int, default=10,
+                        help="waves the searches of an outage scenario are split into")
+    parser.add_argument("--wave-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ Copyright (c) 2017 Joshua Butt
 """
 import asyncio
 import logging
+import logging.handlers
+import queue
 
 import discord
 from discord.ext import commands
@@ -23,14 +25,26 @@ bot_config = {
     'owner_id': OWNER_ID,
     'fetch_offline_members': False
 }
-bot = commands.Bot(**bot_config)
+
+if SHARDED or SHARD_IDS is not None:
+    bot = commands.AutoShardedBot(
+        shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_config)
+else:
+    bot = commands.Bot(**bot_config)
 
 bot.log = logging.getLogger()
 bot.log.setLevel(logging.INFO if DEBUG else logging.WARNING)
-handler = logging.FileHandler(filename=f"{APP_NAME}.log")
+handler = logging.FileHandler(
+    filename=f"{APP_NAME}-{CLUSTER_WORKER}.log" if CLUSTER_WORKER is not None else f"{APP_NAME}.log")
 formatter = logging.Formatter("{asctime} - {levelname} - {message}", style="{")
 handler.setFormatter(formatter)
-bot.log.addHandler(handler)
+
+# Records are queued from coroutines and written to disk by a background thread
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(
+    log_queue, handler, respect_handler_level=True)
+bot.log.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener.start()
 bot.log.info("Instance started.")
 
 
@@ -49,6 +63,7 @@ async def on_ready():
 | User ID: {bot.user.id}
 | Owner: {bot.owner}
 | Guilds: {len(bot.guilds)}
+| Shards: {", ".join(map(str, bot.shards)) if isinstance(bot, commands.AutoShardedBot) else "-"} of {bot.shard_count or 1}
 # -------------------------------------#""")
 
 
@@ -89,6 +104,9 @@ if __name__ == "__main__":
             bot.log.error(error)
             print(error)
 
-    bot.run(TOKEN, bot=not IS_SELFBOT)
+    try:
+        bot.run(TOKEN, bot=not IS_SELFBOT)
+    finally:
+        log_listener.stop()
 
     raise Exception("Bot Restarting...")
@@ -0,0 +1,230 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cluster.py
+Multi-process cluster launcher
+
+Runs bot.py as several worker processes, each owning a contiguous range
+of shards and the player sessions of the guilds on them. Workers which
+exit are restarted and their metrics are served together, labelled by
+worker, on the usual metrics endpoint.
+
+    python cluster.py --workers 4
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from config import *
+from cogs.utils.metrics import METRICS_HOST, METRICS_PORT, Registry
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+GATEWAY_URL = "https://discordapp.com/api/v6/gateway/bot"
+
+log = logging.getLogger("cluster")
+
+
+def shard_ranges(shard_count, workers):
+    """Splits shards into ``workers`` contiguous ranges of near equal size"""
+    workers = min(workers, shard_count)
+    size, extra = divmod(shard_count, workers)
+    ranges, start = list(), 0
+    for worker in range(workers):
+        end = start + size + (worker < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def recommended_shards(token):
+    """Returns the number of shards Discord recommends for the bot"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_URL, headers={"Authorization": f"Bot {token}"}) as resp:
+            resp.raise_for_status()
+            return (await resp.json())["shards"]
+
+
+def _label_sample(line, worker):
+    """Adds a worker label to a sample line of the Prometheus text format"""
+    name_end = min(index for index in (line.find("{"), line.find(" ")) if index != -1)
+    if line[name_end] == "{":
+        return f'{line[:name_end]}{{worker="{worker}",{line[name_end + 1:]}'
+    return f'{line[:name_end]}{{worker="{worker}"}}{line[name_end:]}'
+
+
+def merge_metrics(outputs):
+    """Merges the metrics of each worker, given as ``(worker, text)`` pairs
+
+    Samples of each metric are grouped under a single HELP and TYPE as
+    the text format requires.
+    """
+    families = dict()
+    for worker, text in outputs:
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                family = line.split(" ", 3)[2]
+                headers, samples = families.setdefault(family, (list(), list()))
+                if line not in headers:
+                    headers.append(line)
+            elif line and not line.startswith("#"):
+                families.setdefault(family, (list(), list()))[
+                    1].append(_label_sample(line, worker))
+
+    return "".join("\n".join(headers + samples) + "\n" for headers, samples in families.values())
+
+
+class Worker:
+    """A bot process owning a range of shards"""
+
+    def __init__(self, worker_id, shard_ids, shard_count, metrics_port):
+
+        self.id = worker_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.metrics_port = metrics_port
+
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.restart_delay = CLUSTER_RESTART_DELAY
+
+    @property
+    def environment(self):
+        environment = dict(os.environ)
+        environment.update({
+            "MP3BOT_CLUSTER_WORKER": str(self.id),
+            "MP3BOT_SHARD_IDS": ",".join(map(str, self.shard_ids)),
+            "MP3BOT_SHARD_COUNT": str(self.shard_count),
+            "MP3BOT_METRICS_HOST": METRICS_HOST,
+            "MP3BOT_METRICS_PORT": str(self.metrics_port)
+        })
+        return environment
+
+    @property
+    def is_running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_FILE, env=self.environment, cwd=os.path.dirname(BOT_FILE))
+        self.started = time.monotonic()
+        log.info(f"Worker {self.id} started with pid {self.process.pid} for shards "
+                 f"{self.shard_ids[0]}-{self.shard_ids[-1]} of {self.shard_count}")
+
+    def terminate(self):
+        if self.is_running:
+            self.process.terminate()
+
+
+class Cluster:
+    """Supervises workers and serves their merged metrics"""
+
+    def __init__(self, workers):
+
+        self.workers = workers
+        self.stopping = False
+        self.stopped = asyncio.Event()  # set by stop() to cut restart delays short
+        self.runner = None
+
+        self.registry = Registry()
+        self.restarts = self.registry.counter(
+            "cluster_worker_restarts_total", "Worker restarts", ["worker"])
+        self.registry.gauge("cluster_worker_up", "Whether each worker process is running", ["worker"],
+                            function=lambda: {(worker.id,): int(worker.is_running) for worker in self.workers})
+
+    async def _supervise(self, worker):
+        while not self.stopping:
+            await worker.start()
+            returncode = await worker.process.wait()
+            if self.stopping:
+                return
+
+            # Back off workers that crash straight after starting, e.g. when they can't log in
+            if time.monotonic() - worker.started < CLUSTER_STABLE_TIME:
+                worker.restart_delay = min(
+                    worker.restart_delay * 2, CLUSTER_RESTART_MAX_DELAY)
+            else:
+                worker.restart_delay = CLUSTER_RESTART_DELAY
+
+            log.error(f"Worker {worker.id} exited with code {returncode}, "
+                      f"restarting in {worker.restart_delay}s")
+            worker.restarts += 1
+            self.restarts.inc(worker.id)
+            try:
+                await asyncio.wait_for(self.stopped.wait(), worker.restart_delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _scrape(self, session, worker):
+        try:
+            async with session.get(f"http://{METRICS_HOST}:{worker.metrics_port}/metrics") as resp:
+                return worker.id, await resp.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return worker.id, ""
+
+    async def _handle_metrics(self, request):
+        timeout = aiohttp.ClientTimeout(total=CLUSTER_SCRAPE_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            outputs = await asyncio.gather(*(self._scrape(session, worker) for worker in self.workers))
+        return web.Response(text=merge_metrics(outputs) + self.registry.render(), content_type="text/plain")
+
+    async def _start_server(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, METRICS_HOST, METRICS_PORT).start()
+        log.info(f"Serving cluster metrics on {METRICS_HOST}:{METRICS_PORT}")
+
+    async def run(self):
+        await self._start_server()
+        try:
+            await asyncio.gather(*(self._supervise(worker) for worker in self.workers))
+        finally:
+            await self.runner.cleanup()
+
+    def stop(self):
+        self.stopping = True
+        self.stopped.set()
+        for worker in self.workers:
+            worker.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=CLUSTER_WORKERS,
+                        help="number of worker processes, defaults to the number of cores")
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT,
+                        help="total number of shards, defaults to Discord's recommendation")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="{asctime} - {levelname} - {message}", style="{")
+    loop = asyncio.get_event_loop()
+
+    shard_count = args.shards or loop.run_until_complete(
+        recommended_shards(TOKEN))
+    workers = [Worker(worker_id, shard_ids, shard_count, METRICS_PORT + 1 + worker_id)
+               for worker_id, shard_ids in enumerate(shard_ranges(shard_count, args.workers))]
+
+    cluster = Cluster(workers)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, cluster.stop)
+
+    loop.run_until_complete(cluster.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -7,18 +7,50 @@ Discord administration cog
 Copyright (c) 2017 Joshua Butt
 """
 import asyncio
+import collections
+import cProfile
 import inspect
-import os
+import io
+import pstats
 import re
+import sys
+import threading
+import time
+import tracemalloc
 
 import discord
 from discord.ext import commands
 
 
+def sample_stacks(seconds, interval):
+    """Samples the stacks of all threads, returning a Counter of collapsed stacks"""
+    samples = collections.Counter()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    this_thread = threading.get_ident()
+
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == this_thread:
+                continue
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return samples
+
+
 class Admin:
 
     def __init__(self, bot):
         self.bot = bot
+        self._snapshot = None
 
     async def _response(self, ctx, title: str, *, description: str = None, colour=None, timeout=3):
         """Send embed message response"""
@@ -125,20 +157,115 @@ class Admin:
         else:
             await ctx.send(response_str)
 
-    def pull(self):
-        resp = os.popen("sudo git pull").read()
-        return f"```diff\n{resp}\n```"
+    @commands.command(pass_context=True, hidden=True)
+    @commands.is_owner()
+    async def profile(self, ctx, seconds: float = 10, top: int = 40):
+        """Profiles the event loop with cProfile for a number of seconds"""
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+
+        result = io.StringIO()
+        stats = pstats.Stats(profiler, stream=result)
+        stats.sort_stats("cumulative").print_stats(top)
+        stats.sort_stats("tottime").print_stats(top)
+
+        await ctx.send(f"Profiled event loop for {seconds}s",
+                       file=discord.File(io.BytesIO(result.getvalue().encode("utf-8")), "profile.txt"))
+
+    @commands.command(pass_context=True, hidden=True)
+    @commands.is_owner()
+    async def sample(self, ctx, seconds: float = 10, interval: float = 0.005, top: int = 40):
+        """Samples the stacks of every thread for a number of seconds
+
+        The attachment lists the functions seen most often on top of a
+        stack, followed by collapsed stacks usable with flamegraph.pl.
+        """
+        samples = await self.bot.loop.run_in_executor(None, sample_stacks, seconds, interval)
+        total = sum(samples.values()) or 1
+
+        leaves = collections.Counter()
+        for stack, count in samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+
+        result = [f"{total} samples over {seconds}s\n"]
+        result += [f"{count / total:7.2%}  {function}" for function,
+                   count in leaves.most_common(top)]
+        result += ["", "Collapsed stacks:"]
+        result += [f"{stack} {count}" for stack,
+                   count in samples.most_common()]
+
+        await ctx.send(f"Sampled all threads for {seconds}s",
+                       file=discord.File(io.BytesIO("\n".join(result).encode("utf-8")), "samples.txt"))
+
+    async def _take_snapshot(self):
+        """Takes a snapshot of traced allocations, leaving out tracemalloc's own"""
+        snapshot = await self.bot.loop.run_in_executor(None, tracemalloc.take_snapshot)
+        return snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    @commands.command(pass_context=True, hidden=True)
+    @commands.is_owner()
+    async def memory(self, ctx, action: str = "snapshot", top: int = 30):
+        """Traces memory allocations
+
+        Actions:
+            start    - starts tracing allocations
+            snapshot - takes a snapshot, showing the difference from the last one
+            stop     - stops tracing allocations
+        """
+        if action == "start":
+            tracemalloc.start(25)
+            self._snapshot = await self._take_snapshot()
+            await self._response(ctx, "Started tracing memory allocations", colour=0x009688)
+            return
+
+        if action == "stop":
+            tracemalloc.stop()
+            self._snapshot = None
+            await self._response(ctx, "Stopped tracing memory allocations", colour=0x009688)
+            return
+
+        if not tracemalloc.is_tracing():
+            await self._response(ctx, "Memory allocations are not being traced", description=f"Start tracing with `{ctx.prefix}memory start`", colour=0xf44336)
+            return
+
+        snapshot = await self._take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+
+        result = [f"Traced: {current / 1024:.1f} KiB, peak: {peak / 1024:.1f} KiB", "", "Top allocations:"]
+        result += [str(stat) for stat in snapshot.statistics("lineno")[:top]]
+        if self._snapshot is not None:
+            result += ["", "Change since last snapshot:"]
+            result += [str(stat) for stat in snapshot.compare_to(self._snapshot, "lineno")[:top]]
+            result += ["", "Largest growth by traceback:"]
+            for stat in snapshot.compare_to(self._snapshot, "traceback")[:3]:
+                result.append(str(stat))
+                result += stat.traceback.format()
+        self._snapshot = snapshot
+
+        await ctx.send("Memory snapshot",
+                       file=discord.File(io.BytesIO("\n".join(result).encode("utf-8")), "memory.txt"))
+
+    async def pull(self):
+        process = await asyncio.create_subprocess_shell(
+            "sudo git pull", stdout=asyncio.subprocess.PIPE)
+        resp, _ = await process.communicate()
+        return f"```diff\n{resp.decode('utf-8', 'replace')}\n```"
 
     @commands.command(pass_context=True, name="pull", hidden=True)
     @commands.is_owner()
     async def _pull(self, ctx):
-        await self._response(ctx, "Git Pull", description=self.pull(), colour=0x009688, timeout=None)
+        await self._response(ctx, "Git Pull", description=await self.pull(), colour=0x009688, timeout=None)
 
     @commands.command(pass_context=True, name="restart", hidden=True)
     @commands.is_owner()
     async def _restart(self, ctx, *, arg=None):
         if arg == "pull":
-            await self._response(ctx, "Git Pull", description=self.pull(), colour=0x009688)
+            await self._response(ctx, "Git Pull", description=await self.pull(), colour=0x009688)
         await ctx.send(embed=discord.Embed(title="Restarting...", colour=0x009688))
         await self.bot.logout()
 
@@ -9,15 +9,26 @@ Copyright (c) 2017 Joshua Butt
 
 import asyncio
 import json
+import re
+import time
 
 from re import findall
 
 import discord
 from discord.ext import commands
 
+from ..utils.metrics import registry
+from .audio_worker import AudioWorkerPool
+from .catalog import open_catalog
 from .config import *
+from .encoder import cpu_pressure
 from .player import Playlist, Session
 from .search import *
+from .transcoder import TranscoderScheduler
+
+
+request_interactive_time = registry.histogram(
+    "player_request_interactive_seconds", "Time from a request command to its results being selectable")
 
 
 class SearchConverter(commands.Converter):
@@ -42,6 +53,52 @@ class Player:
     def __init__(self, bot):
         self.bot = bot
         self.sessions = dict()
+        self.audio_workers = AudioWorkerPool(
+            self.bot.loop, self.bot.log, workers=AUDIO_WORKERS) if AUDIO_WORKERS else None
+        self.transcoders = TranscoderScheduler(
+            self.bot.loop, self.bot.log, audio_workers=self.audio_workers)
+
+        self.cpu_pressure = cpu_pressure()
+
+        registry.gauge("player_queue_length", "Requests queued per session", ["guild"],
+                       function=lambda: {(str(session.guild.id),): len(session.playlist.requests) for session in self.sessions.values()})
+        registry.gauge("player_encoder_settings", "Opus encoder bitrate in kbps and complexity per session", ["guild", "setting"],
+                       function=lambda: {(str(session.guild.id), setting): getattr(session.encoder_policy, setting)
+                                         for session in self.sessions.values() for setting in ("bitrate", "complexity")})
+        registry.gauge("player_cpu_pressure", "Share of time tasks on the host waited for a cpu",
+                       function=lambda: {(): self.cpu_pressure})
+
+        self.bot.loop.create_task(self._load_catalog())
+        self.encoder_monitor = self.bot.loop.create_task(
+            self._encoder_policy_task())
+
+    def __unload(self):
+        self.encoder_monitor.cancel()
+        self.transcoders.stop()
+        if self.audio_workers is not None:
+            self.audio_workers.stop()
+
+    async def _load_catalog(self):
+        """Builds the library catalog ahead of sessions needing it"""
+        try:
+            await self.bot.loop.run_in_executor(None, open_catalog, DEFAULT_PLAYLIST_DIRECTORY)
+        except OSError as e:
+            self.bot.log.error(
+                f"Failed to load library catalog: {type(e).__name__}: {e}")
+
+    async def _open_playlist(self, **playlist_config):
+        """Returns a :class:`Playlist`, opening its catalog in an executor"""
+        directory = playlist_config.get("playlist_directory", None) or DEFAULT_PLAYLIST_DIRECTORY
+        catalog = await self.bot.loop.run_in_executor(None, open_catalog, directory)
+        return Playlist(self.bot.log, catalog, loop=self.bot.loop, **playlist_config)
+
+    async def _encoder_policy_task(self):
+        """Adapts every session's encoder to host cpu pressure"""
+        while True:
+            await asyncio.sleep(ENCODER_POLICY_INTERVAL)
+            self.cpu_pressure = cpu_pressure()
+            for session in list(self.sessions.values()):
+                session.update_encoder()
 
     def _get_session(self, ctx):
         return self.sessions.get(ctx.guild.id, None)
@@ -162,7 +219,7 @@ class Player:
         if len(session.repeat_requests) >= count_needed or len(listeners) == 1 or session.current_track.requester == ctx.author:
             e = discord.Embed(title="Repeat track request",
                               description="Repeat track...", colour=0x004d40)
-            session.playlist.add_request(session.current_track, front=True)
+            session.add_request(session.current_track, front=True)
 
         # if no-one has requested
         elif len(session.repeat_requests) == 0:
@@ -192,7 +249,87 @@ class Player:
             name=f"Repeat request - requested by: {ctx.author.name}", icon_url=ctx.author.avatar_url)
         await ctx.send(embed=e)
 
-        session.playlist.add_request(session.current_track, front=True)
+        session.add_request(session.current_track, front=True)
+
+    async def _get_request_session(self, ctx):
+        """Returns the current session, connecting to the author's voice channel if there is none"""
+        session = self._get_session(ctx)
+        if session is None:
+            if ctx.author.voice is not None:
+                voice = await ctx.author.voice.channel.connect()
+                session = Session(self.bot, self, voice, None)
+                self.sessions[ctx.guild.id] = session
+            else:
+                raise TrackError("You are not in a voice channel...")
+        return session
+
+    def _request_count(self, session, member):
+        """Returns the number of requests a member has queued"""
+        return len([track for track in session.playlist.requests if track.requester == member])
+
+    async def _seed_reactions(self, message, emojis):
+        """Adds selection reactions to a message
+
+        They are added one at a time, as discord shows reactions in the
+        order they were first added and the numbers must match the results.
+        """
+        for emoji in emojis:
+            try:
+                await message.add_reaction(emoji)
+            except discord.HTTPException as e:
+                self.bot.log.warning(
+                    f"Failed to add selection reaction: {type(e).__name__}: {e}")
+                return
+
+    async def _select_track(self, ctx, result_message, tracks):
+        """Waits for the requester to choose one of the tracks in a result message
+
+        A track can be chosen by reacting to the message or replying with its number.
+        Selections are accepted while the reactions are still being added.
+        """
+        vote_reaction_emojis = [
+            (str(i).encode("utf-8") + b"\xe2\x83\xa3").decode("utf-8") for i in range(1, len(tracks) + 1)]
+
+        def reaction_check(reaction, user):
+            return all([
+                user == ctx.author,
+                reaction.message.id == result_message.id,
+                reaction.emoji in vote_reaction_emojis
+            ])
+
+        def message_check(message):
+            return all([
+                message.author == ctx.author,
+                message.channel == ctx.channel,
+                message.content.strip() in [str(i) for i in range(1, len(tracks) + 1)]
+            ])
+
+        # Listeners are registered before any reactions are seeded
+        waiters = [
+            self.bot.loop.create_task(self.bot.wait_for(
+                'reaction_add', timeout=SEARCH_RESULT_TIMEOUT, check=reaction_check)),
+            self.bot.loop.create_task(self.bot.wait_for(
+                'message', timeout=SEARCH_RESULT_TIMEOUT, check=message_check))
+        ]
+        seeding = self.bot.loop.create_task(
+            self._seed_reactions(result_message, vote_reaction_emojis))
+
+        try:
+            done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            seeding.cancel()
+            for waiter in waiters:
+                waiter.cancel()
+
+        try:
+            result = done.pop().result()
+        except asyncio.TimeoutError:
+            raise TrackError("You did not choose a track in time")
+
+        if isinstance(result, discord.Message):
+            return tracks[int(result.content.strip()) - 1]
+        reaction, user = result
+        return tracks[int(reaction.emoji[0]) - 1]
 
     @commands.command(name="request")
     @commands.check(_is_guild)
@@ -208,23 +345,14 @@ class Player:
         Clyp:       Play track from Clyp given a URL or ID
         ```
         """
+        started = time.perf_counter()
         await ctx.trigger_typing()
 
-        session = self._get_session(ctx)
-        if session is None:
-            if ctx.author.voice is not None:
-                voice = await ctx.author.voice.channel.connect()
-                session = Session(self.bot, self, voice, self)
-                self.sessions[ctx.guild] = session
-            else:
-                raise TrackError("You are not in a voice channel...")
-
-        vote_reaction_emojis = [
-            (str(i).encode("utf-8") + b"\xe2\x83\xa3").decode("utf-8") for i in range(1, 9)]
+        session = await self._get_request_session(ctx)
 
-        if len([track for track in session.playlist.requests if track.requester == ctx.author]) > 1:
+        if self._request_count(session, ctx.author) >= REQUEST_LIMIT:
             embed = discord.Embed(title="Your request cannot be processed",
-                                  description=f"You can only request up-to two songs in advance...\nFor more information type `{ctx.prefix}help {ctx.command.name}`.", colour=0xe57a80)
+                                  description=f"You can only request up-to {REQUEST_LIMIT} songs in advance...\nFor more information type `{ctx.prefix}help {ctx.command.name}`.", colour=0xe57a80)
             embed.set_author(
                 name=f"Error: {ctx.command.name}", icon_url=ctx.bot.user.avatar_url)
             await ctx.send(embed=embed)
@@ -232,30 +360,21 @@ class Player:
 
         try:
             search = search_type(self.bot.log, query, ctx.author)
-            await search.get()
+            with search_latency.time(search_type.__name__):
+                await search.get()
 
             result_message = await ctx.send(**search.search_embed)
+            request_interactive_time.observe(time.perf_counter() - started)
+            self.bot.log.info(
+                f"Request results interactive after {time.perf_counter() - started:.3f}s")
 
-            for index, track in enumerate(search.tracks):
-                await result_message.add_reaction(vote_reaction_emojis[index])
-
-            # listen for reaction result
-            def check(reaction, user):
-                return all([
-                    user == ctx.author,
-                    reaction.message.id == result_message.id,
-                    reaction.emoji in vote_reaction_emojis[:len(search.tracks)]
-                ])
-            try:
-                reaction, user = await self.bot.wait_for('reaction_add', timeout=60, check=check)
-            except asyncio.TimeoutError:
-                raise TrackError("You did not choose a track in time")
-
+            track = await self._select_track(ctx, result_message, search.tracks)
             await result_message.delete()
-            track = search.tracks[int(reaction.emoji[0]) - 1]
 
-            session.playlist.add_request(track)
+            session.add_request(track)
             await ctx.send(**track.request_embed)
+            self.bot.log.info(
+                f"Request completed after {time.perf_counter() - started:.3f}s")
 
         except Exception as e:
             self.bot.log.error(type(e).__name__ + ': ' + str(e))
@@ -265,6 +384,103 @@ class Player:
                 name=f"Error: {ctx.command.name}", icon_url=self.bot.user.avatar_url)
             await ctx.send(embed=embed)
 
+    @commands.command(name="complete")
+    @commands.check(_is_guild)
+    async def player_complete(self, ctx, *, text: str):
+        """Lists local tracks with a title or artist starting with what you've typed.
+
+        Every word is matched against the start of a word, e.g. `north li`.
+        Use `request mp3` with the title to add a track to the queue.
+        """
+        catalog = await self.bot.loop.run_in_executor(None, open_catalog, DEFAULT_PLAYLIST_DIRECTORY)
+
+        suggestion = None
+        tracks = catalog.complete(text)
+        if not tracks:
+            suggestion = catalog.did_you_mean(text)
+            if suggestion is not None:
+                tracks = catalog.complete(suggestion)
+
+        # the text goes in the description, titles are limited to 256 characters
+        description = f"Starting with **{text[:200]}**\n\n"
+        if suggestion:
+            description += f"Did you mean **{suggestion}**?\n"
+        for index, tags in enumerate(map(catalog.tags, tracks)):
+            description += f"{index+1} - {tags['title']} by {tags['artist']}\n"
+        if not tracks:
+            description += "No local tracks found..."
+
+        embed = discord.Embed(title="Local track completions", description=description, colour=0xe57a80)
+        embed.set_author(
+            name=f"Local Tracks - requested by {ctx.author.name}", icon_url=ctx.author.avatar_url)
+        await ctx.send(embed=embed)
+
+    @commands.command(name="import")
+    @commands.check(_is_guild)
+    @commands.check(_has_permission)
+    async def player_import_requests(self, ctx, *, items: str):
+        """Adds a list of requests to the queue.
+
+        Items are separated by new lines or commas and may be any of:
+        ```yaml
+        Clyp:    A Clyp URL or clyp:ID
+        YouTube: A YouTube URL or yt:VIDEO_ID
+        MP3:     A file name or search query for the local song playlist
+        ```
+        Tracks are added as soon as they are found.
+        Administrators may queue up-to 50 requests, everyone else is limited as with request.
+        """
+        session = await self._get_request_session(ctx)
+        limit = IMPORT_REQUEST_LIMIT if Player._is_admin(ctx) else REQUEST_LIMIT
+
+        queue = asyncio.Queue()
+        for item in re.split(r"[\n,]", items):
+            if item.strip():
+                queue.put_nowait(item.strip())
+
+        embed = discord.Embed(title="Importing requests...",
+                              description=f"searching for **{queue.qsize()}** tracks...", colour=0x004d40)
+        embed.set_author(
+            name=f"Import - requested by: {ctx.author.name}", icon_url=ctx.author.avatar_url)
+        await ctx.send(embed=embed)
+
+        added, failed, skipped = list(), list(), list()
+
+        async def worker():
+            while not queue.empty():
+                item = queue.get_nowait()
+                if self._request_count(session, ctx.author) >= limit:
+                    skipped.append(item)
+                    continue
+
+                try:
+                    track = await import_track(self.bot.log, item, ctx.author)
+                except Exception as e:
+                    self.bot.log.error(
+                        f"Failed to import {item}: {type(e).__name__}: {e}")
+                    failed.append(item)
+                    continue
+
+                # checked again as other workers may have added tracks meanwhile
+                if self._request_count(session, ctx.author) >= limit:
+                    skipped.append(item)
+                else:
+                    session.add_request(track)
+                    added.append(track)
+
+        await asyncio.gather(*(worker() for i in range(IMPORT_WORKERS)))
+
+        embed = discord.Embed(title="Import complete",
+                              description=f"added **{len(added)}** tracks to the queue...", colour=0x004d40)
+        if failed:
+            embed.add_field(name="Not found", value="\n".join(failed)[:1024], inline=False)
+        if skipped:
+            embed.add_field(name="Over request limit",
+                            value="\n".join(skipped)[:1024], inline=False)
+        embed.set_author(
+            name=f"Import - requested by: {ctx.author.name}", icon_url=ctx.author.avatar_url)
+        await ctx.send(embed=embed)
+
     @commands.command(name="volume")
     @commands.check(_is_guild)
     @commands.check(_is_session)
@@ -305,13 +521,7 @@ class Player:
     async def player_get_queue(self, ctx):
         """Retrieves the next 10 upcoming tracks."""
         session = self._get_session(ctx)
-        embed = discord.Embed(
-            title=f"{self.bot.user.name} Playlist for {ctx.guild.name} - Upcoming songs:", description="", colour=0x004d40)
-
-        for track in session.playlist.queue:
-            embed.add_field(**track.queue, inline=False)
-
-        await ctx.send(embed=embed)
+        await ctx.send(embed=session.queue_embed)
 
     @commands.command(name="start_player")
     @commands.check(_is_guild)
@@ -330,7 +540,7 @@ class Player:
             "voice": await voice_channel.connect(),
             "cog": self,
             "log_channel": log_channel,
-            "playlist": Playlist(self.bot.log)
+            "playlist": await self._open_playlist()
         }
         self.sessions[session_config["voice"].guild.id] = Session(
             **session_config)
@@ -345,14 +555,19 @@ class Player:
         except commands.BadArgument:
             log_channel = None
 
-        startup_list = json.load(open(SESSIONS_FILE))
-        startup_list.append(
-            {
-                "voice_channel": voice_channel.id,
-                "log_channel": log_channel
-            }
-        )
-        json.dump(startup_list, open(SESSIONS_FILE, "w"))
+        def save_session():
+            with open(SESSIONS_FILE) as sessions_file:
+                startup_list = json.load(sessions_file)
+            startup_list.append(
+                {
+                    "voice_channel": voice_channel.id,
+                    "log_channel": log_channel
+                }
+            )
+            with open(SESSIONS_FILE, "w") as sessions_file:
+                json.dump(startup_list, sessions_file)
+
+        await self.bot.loop.run_in_executor(None, save_session)
 
         embed = discord.Embed(
             title="Permanently adding player...", description="saving...", colour=0x004d40)
@@ -377,7 +592,6 @@ class Player:
     async def player_restart_session(self, ctx):
         """Restarts the player in the current guild."""
         old_session = self._get_session(ctx)
-        old_session.stop()
 
         embed = discord.Embed(title="Restarting Player...",
                               description="restarting...", colour=0x004d40)
@@ -385,6 +599,13 @@ class Player:
             name=f"Player Restart - requested by: {ctx.author.name}", icon_url=ctx.author.avatar_url)
         await ctx.send(embed=embed)
 
+        # reconnecting carries on the current track, only a stopped player is replaced
+        player_task = getattr(old_session, "player", None)
+        if old_session.is_playing and player_task is not None and not player_task.done():
+            await old_session.reconnect()
+            return
+
+        old_session.stop()
         session_config = {
             "bot": self.bot,
             "voice": await old_session.voice.channel.connect(),
@@ -397,22 +618,79 @@ class Player:
         self.sessions[session_config["voice"].guild.id] = Session(
             **session_config)
 
+    @commands.command(name="frames", hidden=True)
+    @commands.is_owner()
+    async def player_get_frame_stats(self, ctx, guild_id: int = None):
+        """Displays audio frame timings for a guild's player."""
+        session = self.sessions.get(guild_id or getattr(ctx.guild, "id", None), None)
+        if session is None:
+            raise commands.BadArgument("There is no player running in that guild")
+
+        policy = session.encoder_policy
+        await ctx.send(f"```\nFrame timings (ms) for {session.guild}\n{session.frame_stats.summary}\n"
+                       f"encoder: {policy.bitrate}kbps complexity {policy.complexity}, "
+                       f"host cpu pressure {self.cpu_pressure:.2f}\n```")
+
+    @commands.command(name="transcoders", hidden=True)
+    @commands.is_owner()
+    async def player_get_transcoders(self, ctx):
+        """Lists running ffmpeg processes with their cpu and memory usage."""
+        transcoders = self.transcoders
+        embed = discord.Embed(
+            title=f"Transcoders - {transcoders.active}/{transcoders.limit} running, {len(transcoders.waiters)} waiting", description="", colour=0x004d40)
+
+        for source in transcoders.sources.values():
+            source.sample()
+            embed.add_field(
+                name=f"{source.pid} - {source.guild}",
+                value=f"{source.cpu_percent:.1f}% cpu, {source.rss // 1024} KiB{' (reniced)' if source.reniced else ''}", inline=False)
+
+        await ctx.send(embed=embed)
+
+    @commands.command(name="transcoder_renice", hidden=True)
+    @commands.is_owner()
+    async def player_renice_transcoder(self, ctx, pid: int, niceness: int = TRANSCODER_NICENESS):
+        """Sets the niceness of an ffmpeg process."""
+        source = self.transcoders.get(pid)
+        if source is None:
+            raise commands.BadArgument(f"No transcoder with process ID {pid}")
+        source.renice(niceness)
+        await ctx.send(embed=discord.Embed(title=f"Reniced transcoder {pid} to {niceness}", colour=0x004d40))
+
+    @commands.command(name="transcoder_kill", hidden=True)
+    @commands.is_owner()
+    async def player_kill_transcoder(self, ctx, pid: int):
+        """Kills an ffmpeg process, skipping its track."""
+        source = self.transcoders.get(pid)
+        if source is None:
+            raise commands.BadArgument(f"No transcoder with process ID {pid}")
+        source.kill()
+        await ctx.send(embed=discord.Embed(title=f"Killed transcoder {pid}", colour=0x004d40))
+
     async def on_ready(self):
         for session in INITIAL_SESSIONS:  # Start Inital player sessions
 
+            # Channels in guilds on another worker's shards aren't visible to this one
+            voice_channel = self.bot.get_channel(session["voice_channel"])
+            if voice_channel is None:
+                self.bot.log.info(
+                    f"Skipping session for channel: {session['voice_channel']}, not on this shard")
+                continue
+            if voice_channel.guild.id in self.sessions:  # on_ready fires again after reconnecting
+                continue
+
             try:
                 session_config = {
                     "bot": self.bot,
-                    "voice": await self.bot.get_channel(session["voice_channel"]).connect(),
+                    "voice": await voice_channel.connect(),
                     "cog": self,
                     "log_channel": self.bot.get_channel(session["log_channel"])
                 }
 
                 if session.get("playlist", None):
-                    session_config["playlist"] = Playlist(
-                        self.bot.log, **session["playlist"])
+                    session_config["playlist"] = await self._open_playlist(**session["playlist"])
                 else:
-                    session_config["playlist"] = Playlist(self.bot.log)
+                    session_config["playlist"] = await self._open_playlist()
 
                 if session.get("permissions", None):
                     permissions = dict()
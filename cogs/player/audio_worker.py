@@ -0,0 +1,442 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/audio_worker.py
+Audio worker processes
+
+Streams are decoded by ffmpeg, volume scaled and Opus encoded in worker
+processes. Finished frames are handed back through shared memory rings,
+so the bot process only copies them out and sends them.
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import asyncio
+import audioop
+import ctypes
+import ctypes.util
+import itertools
+import mmap
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from multiprocessing.connection import Connection
+
+import discord
+
+from ..utils.metrics import registry
+from .config import *
+from .encoder import configure_encoder, encoder_time
+from .read_ahead import ffmpeg_source
+
+__all__ = [
+    "AudioWorkerPool",
+    "FrameRing",
+    "WorkerSource"
+]
+
+FRAME_LENGTH = 0.02  # seconds of audio per frame
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE  # bytes of PCM per frame, larger than any Opus frame
+OPUS_SILENCE = b"\xf8\xff\xfe"
+ENCODER_REPORT_FRAMES = 250  # frames between reports of a stream's encoding time
+
+BOT_DIRECTORY = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+RING_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+_ring_ids = itertools.count()
+
+
+class FrameRing:
+    """Ring of audio frames in a memory mapped file shared by two processes
+
+    There is exactly one producer and one consumer. The header holds a
+    count of frames written, only updated by the producer, a count of
+    frames read, only updated by the consumer, and an end flag. Each
+    slot holds a length prefixed frame.
+    """
+
+    HEADER_SIZE = 24
+    LENGTH = struct.Struct("<H")
+    SLOT_SIZE = LENGTH.size + FRAME_SIZE
+
+    def __init__(self, path, slots, *, create=False):
+
+        self.path = path
+        self.slots = slots
+        size = self.HEADER_SIZE + slots * self.SLOT_SIZE
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL if create else os.O_RDWR, 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        # aligned 8 byte fields are read and written whole
+        self._written = ctypes.c_uint64.from_buffer(self.mmap, 0)
+        self._read = ctypes.c_uint64.from_buffer(self.mmap, 8)
+        self._ended = ctypes.c_uint64.from_buffer(self.mmap, 16)
+
+    @classmethod
+    def create(cls, slots=None):
+        """Returns a new ring in shared memory"""
+        path = os.path.join(
+            RING_DIRECTORY, f"mp3bot-{os.getpid()}-{next(_ring_ids)}.ring")
+        return cls(path, slots or AUDIO_WORKER_BUFFER, create=True)
+
+    def __len__(self):
+        return self._written.value - self._read.value
+
+    @property
+    def ended(self):
+        return bool(self._ended.value)
+
+    def end(self):
+        """Marks that no more frames will be written"""
+        self._ended.value = 1
+
+    def put(self, frame):
+        """Writes a frame, returning False if the ring is full"""
+        written = self._written.value
+        if written - self._read.value >= self.slots:
+            return False
+
+        offset = self.HEADER_SIZE + (written % self.slots) * self.SLOT_SIZE
+        self.LENGTH.pack_into(self.mmap, offset, len(frame))
+        self.mmap[offset + self.LENGTH.size:offset +
+                  self.LENGTH.size + len(frame)] = frame
+        self._written.value = written + 1
+        return True
+
+    def get(self):
+        """Returns the next frame or None if the ring is empty"""
+        read = self._read.value
+        if read == self._written.value:
+            return None
+
+        offset = self.HEADER_SIZE + (read % self.slots) * self.SLOT_SIZE
+        length, = self.LENGTH.unpack_from(self.mmap, offset)
+        frame = self.mmap[offset + self.LENGTH.size:offset +
+                          self.LENGTH.size + length]
+        self._read.value = read + 1
+        return frame
+
+    def close(self, *, unlink=False):
+        del self._written, self._read, self._ended
+        self.mmap.close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+# - Worker process
+
+class _WorkerStream(threading.Thread):
+    """Decodes, scales and encodes one stream into its ring"""
+
+    def __init__(self, connection, stream_id, ring_path, slots, ffmpeg_input, volume):
+        super().__init__(daemon=True)
+
+        self.connection = connection
+        self.stream_id = stream_id
+        self.ring = FrameRing(ring_path, slots)
+        self.ffmpeg_input = ffmpeg_input
+        self.volume = volume
+        self.encoder_settings = None
+
+        self._stopped = threading.Event()
+
+    def run(self):
+        error = None
+        source = None
+        complexity, encoding, frames = "default", 0, 0
+        try:
+            source = ffmpeg_source(self.ffmpeg_input)
+            encoder = discord.opus.Encoder() if discord.opus.is_loaded() else None
+            self.connection.send(
+                ("opened", self.stream_id, source._process.pid, encoder is not None))
+
+            while not self._stopped.is_set():
+                if len(self.ring) >= self.ring.slots:
+                    self._stopped.wait(FRAME_LENGTH)
+                    continue
+
+                data = source.read()
+                if not data:
+                    break
+                data = audioop.mul(data, 2, min(self.volume, 2.0))
+                if encoder is not None:
+                    if self.encoder_settings is not None:
+                        settings, self.encoder_settings = self.encoder_settings, None
+                        configure_encoder(encoder, *settings)
+                        complexity = str(settings[1])
+
+                    started = time.perf_counter()
+                    data = encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+                    encoding += time.perf_counter() - started
+                    frames += 1
+                    if frames % ENCODER_REPORT_FRAMES == 0:
+                        self.connection.send(
+                            ("encoded", self.stream_id, complexity, encoding))
+                        encoding = 0
+                self.ring.put(data)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            self.ring.end()
+            self.ring.close()
+            if source is not None:
+                source.cleanup()
+            if encoding:
+                self.connection.send(
+                    ("encoded", self.stream_id, complexity, encoding))
+            self.connection.send(("ended", self.stream_id, error))
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _LockedConnection:
+    """Connection whose sends may come from several threads"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            try:
+                self.connection.send(message)
+            except OSError:
+                pass  # the bot process has gone away
+
+
+def _worker_main(fd):
+    """Serves stream commands from the bot process until it disconnects"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # shutdown is left to the bot process
+    if not discord.opus.is_loaded() and ctypes.util.find_library("opus"):
+        discord.opus.load_opus(ctypes.util.find_library("opus"))
+
+    connection = Connection(fd)
+    replies = _LockedConnection(connection)
+    streams = dict()
+
+    while True:
+        try:
+            command, stream_id, *args = connection.recv()
+        except (EOFError, OSError):
+            break
+
+        if command == "open":
+            streams[stream_id] = _WorkerStream(replies, stream_id, *args)
+            streams[stream_id].start()
+        elif command == "volume" and stream_id in streams:
+            streams[stream_id].volume = args[0]
+        elif command == "encoder" and stream_id in streams:
+            streams[stream_id].encoder_settings = tuple(args)
+        elif command == "close" and stream_id in streams:
+            streams.pop(stream_id).stop()
+
+        for stream_id in [stream_id for stream_id, stream in streams.items() if not stream.is_alive()]:
+            del streams[stream_id]
+
+    for stream in streams.values():
+        stream.stop()
+
+
+# - Bot process
+
+class WorkerSource(discord.AudioSource):
+    """Audio source reading frames produced by an audio worker"""
+
+    def __init__(self, worker, stream_id, ring, volume, *, position=0):
+
+        self.worker = worker
+        self.stream_id = stream_id
+        self.ring = ring
+        self._volume = volume
+        self.played = round(position / FRAME_LENGTH)  # frames into the track, not counting silence filled in
+
+        self.pid = None
+        self.encoded = False
+        self.underruns = 0
+        self.opened = worker.pool.loop.create_future()
+
+        self._closed = False
+
+    def is_opus(self):
+        return self.encoded
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+        self.worker.send("volume", self.stream_id, self._volume)
+
+    def configure(self, bitrate, complexity):
+        self.worker.send("encoder", self.stream_id, bitrate, complexity)
+
+    @property
+    def position(self):
+        return self.played * FRAME_LENGTH
+
+    def read(self):
+        frame = self.ring.get()
+        if frame is None:
+            # wait out one frame for the worker before filling with silence
+            deadline = time.perf_counter() + FRAME_LENGTH
+            while frame is None and not self.ring.ended and time.perf_counter() < deadline:
+                time.sleep(0.001)
+                frame = self.ring.get()
+
+            if frame is None:
+                if self.ring.ended:
+                    return b""
+                self.underruns += 1
+                return OPUS_SILENCE if self.encoded else bytes(FRAME_SIZE)
+        self.played += 1
+        return frame
+
+    def cleanup(self):
+        if not self._closed:
+            self._closed = True
+            self.worker.close(self)
+
+
+class AudioWorker:
+    """Handle on one worker process"""
+
+    def __init__(self, pool, index):
+
+        self.pool = pool
+        self.index = index
+        self.streams = dict()
+
+        connection, child = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", f"from {__name__} import _worker_main; _worker_main({child.fileno()})"],
+            cwd=BOT_DIRECTORY, pass_fds=[child.fileno()])
+        child.close()
+
+        self.connection = Connection(connection.detach())
+        self._lock = threading.Lock()
+        self.pool.loop.add_reader(self.connection.fileno(), self._receive)
+
+    @property
+    def is_alive(self):
+        return self.process.poll() is None and not self.connection.closed
+
+    def send(self, *message):
+        # sources are closed from the audio thread
+        with self._lock:
+            try:
+                self.connection.send(message)
+            except OSError:
+                pass
+
+    def open(self, source, ffmpeg_input):
+        self.streams[source.stream_id] = source
+        self.send("open", source.stream_id, source.ring.path,
+                  source.ring.slots, ffmpeg_input, source.volume)
+
+    def close(self, source):
+        self.send("close", source.stream_id)
+        self.pool.loop.call_soon_threadsafe(self._forget, source)
+
+    def _forget(self, source):
+        if self.streams.pop(source.stream_id, None) is not None:
+            source.ring.close(unlink=True)
+
+    def _receive(self):
+        try:
+            while self.connection.poll():
+                command, stream_id, *args = self.connection.recv()
+                if command == "encoded":  # counted even once the stream is closed
+                    encoder_time.inc(args[0], amount=args[1])
+                    continue
+                source = self.streams.get(stream_id, None)
+                if source is None:
+                    continue
+
+                if command == "opened" and not source.opened.done():
+                    source.pid, source.encoded = args
+                    source.opened.set_result(None)
+                elif command == "ended":
+                    if args[0] is not None:
+                        self.pool.log.error(
+                            f"Audio worker {self.index} stream failed: {args[0]}")
+                    if not source.opened.done():
+                        source.opened.set_exception(
+                            OSError(args[0] or "Stream ended before opening"))
+        except (EOFError, OSError):
+            self.pool.log.error(
+                f"Audio worker {self.index} exited with code {self.process.poll()}")
+            self.stop()
+
+    def stop(self):
+        """Stops the worker, ending its streams"""
+        if not self.connection.closed:
+            self.pool.loop.remove_reader(self.connection.fileno())
+            self.connection.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+
+        for source in self.streams.values():
+            source.ring.end()
+            if not source.opened.done():
+                source.opened.set_exception(OSError("Audio worker stopped"))
+
+
+class AudioWorkerPool:
+    """Pool of audio worker processes
+
+    Each stream is given to the worker with the fewest streams. Workers
+    which exit are replaced when the next stream is opened.
+    """
+
+    def __init__(self, loop, log, *, workers=None):
+
+        self.loop = loop
+        self.log = log
+        self._stream_ids = itertools.count()
+        self.workers = [AudioWorker(self, index)
+                        for index in range(workers or AUDIO_WORKERS)]
+
+        registry.gauge("player_audio_worker_streams", "Streams running in each audio worker", ["worker"],
+                       function=lambda: {(str(worker.index),): len(worker.streams) for worker in self.workers})
+
+    async def open(self, track, *, volume=1.0, position=0):
+        """Returns a :class:`WorkerSource` for a track once its worker has started ffmpeg"""
+        for index, worker in enumerate(self.workers):
+            if not worker.is_alive:
+                self.workers[index] = AudioWorker(self, worker.index)
+
+        worker = min(self.workers, key=lambda worker: len(worker.streams))
+        source = WorkerSource(worker, next(self._stream_ids),
+                              FrameRing.create(), volume, position=position)
+        worker.open(source, track.ffmpeg_input_at(position))
+
+        try:
+            await asyncio.wait_for(asyncio.shield(source.opened), AUDIO_WORKER_OPEN_TIMEOUT)
+        except BaseException:  # including cancellation of a prefetch
+            source.cleanup()
+            raise
+        return source
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
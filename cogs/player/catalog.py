@@ -0,0 +1,542 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/catalog.py
+Memory mapped library catalog
+
+The tags and search indexes of a playlist directory are written once to
+a read-only file which every process maps, so the pages are shared rather
+than each process building its own copy.
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import bisect
+import collections
+import difflib
+import fcntl
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import unicodedata
+import zlib
+
+from array import array
+from glob import glob
+
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+
+from ..utils.metrics import registry
+from .config import *
+
+__all__ = [
+    "Catalog",
+    "CatalogError",
+
+    "build_catalog",
+    "open_catalog",
+    "rebuild_catalog",
+    "search_key"
+]
+
+MAGIC = b"MP3CAT\x00\x05"
+
+# magic, tracks, trigrams, postings, words, word postings, directory mtime
+HEADER = struct.Struct("=8sIIIIIq4x")
+# offset and length of path, key, title, artist, album and date, then
+# duration and the offsets to play between, 0 if there is no silence to
+# trim, then the file's mtime and size when it was read
+RECORD = struct.Struct("=12I3fqQ")
+FIELDS = ("path", "key", "title", "artist", "album", "date")
+
+TAGS = (("title", "TIT2"), ("album", "TALB"),
+        ("artist", "TPE1"), ("date", "TDRC"))
+
+catalog_build_time = registry.histogram(
+    "player_catalog_build_seconds", "Time taken to build a library catalog",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+
+class CatalogError(Exception):
+    """"""
+    pass
+
+
+# letters which don't decompose into a base letter and accents
+TRANSLITERATIONS = {
+    "æ": "ae", "œ": "oe", "ø": "o", "đ": "d", "ð": "d", "ħ": "h",
+    "ı": "i", "ł": "l", "ŋ": "n", "þ": "th", "ŧ": "t"
+}
+
+
+class _FoldTable(dict):
+    """:meth:`str.translate` table for decomposed text, filled in as characters are seen
+
+    Accents are dropped, letters are transliterated and anything which
+    isn't part of a word becomes a space.
+    """
+
+    def __missing__(self, code):
+        char = chr(code)
+        if 0x300 <= code < 0x370:  # combining diacritical marks
+            value = None
+        elif char in TRANSLITERATIONS:
+            value = TRANSLITERATIONS[char]
+        elif unicodedata.category(char)[0] in "LMN":
+            value = code
+        else:
+            value = " "
+        self[code] = value
+        return value
+
+
+_fold_table = _FoldTable()
+
+
+def search_key(text):
+    """Returns the normalised form of text used for searching
+
+    Text is casefolded and stripped of accents, and split into words of
+    letters and digits in any script, so "Café-Über" has the key
+    "cafe uber".
+    """
+    text = unicodedata.normalize("NFKD", unicodedata.normalize("NFKD", text).casefold())
+    # recomposed so scripts whose marks are kept, such as kana, stay compact
+    return " ".join(unicodedata.normalize("NFC", text.translate(_fold_table)).split())
+
+
+def _trigrams(key):
+    """Returns the hashes of the trigrams in a search key"""
+    padded = f"  {key} "
+    return {zlib.crc32(padded[index:index + 3].encode("utf-8"))
+            for index in range(len(padded) - 2)}
+
+
+def _read_tags(file):
+    """Returns the tags of a file as :class:`Mp3File` would read them, or None if it can't be played"""
+    try:
+        mp3_file = MP3(file)
+    except MutagenError:
+        return None
+    if mp3_file.tags is None:
+        return None
+
+    tags = dict()
+    for var, tag in TAGS:
+        try:
+            tags[var] = str(mp3_file.tags[tag][0])
+        except KeyError:
+            tags[var] = file.rsplit('/', 1)[1][:4] if var == "title" else "???"
+    tags["duration"] = mp3_file.info.length
+    return tags
+
+
+def _words(tags):
+    """Returns the search keys of the words in a track's title and artist"""
+    return set(search_key(f"{tags['title']} {tags['artist']}").split())
+
+
+def _previous_tags(file):
+    """Returns a dict of path to the mtime and size each file had and its tags, from the catalog being replaced"""
+    try:
+        previous = Catalog(file)
+    except (OSError, CatalogError):
+        return dict()
+
+    return {previous.path(index): (previous.identity(index), previous.tags(index))
+            for index in range(len(previous))}
+
+
+def _read_silence(directory):
+    """Returns the silence analysis of a directory's files, see silence.py"""
+    try:
+        with open(silence_file(directory)) as analysis:
+            return json.load(analysis)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _offsets(path, identity, duration, silence):
+    """Returns the start and end offsets of a file's audio, trimming silence if it has been analyzed"""
+    analysis = silence.get(path, None)
+    if analysis is None or analysis[:2] != list(identity):
+        return 0, 0
+
+    start, end = analysis[2], duration - analysis[3]
+    if end <= start:  # silent throughout
+        return 0, 0
+    return start, (end if analysis[3] else 0)
+
+
+def build_catalog(directory, file):
+    """Writes a catalog of the MP3 files in a directory
+
+    The catalog is written to a temporary file and moved into place, so
+    processes with the old catalog mapped keep a consistent view of it.
+    """
+    started = time.perf_counter()
+    directory_mtime = os.stat(directory).st_mtime_ns
+    silence = _read_silence(directory)
+    previous = _previous_tags(file)
+
+    records = list()
+    strings = bytearray()
+    index = collections.defaultdict(list)
+    words = collections.defaultdict(list)
+
+    def add_string(text):
+        data = text.encode("utf-8", "surrogateescape")
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    for path in sorted(glob(directory + "/*.mp3")):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        identity = (stat.st_mtime_ns, stat.st_size)
+
+        # only files added or changed since the last build are read
+        cached = previous.get(path, None)
+        tags = cached[1] if cached is not None and cached[0] == identity else _read_tags(path)
+        if tags is None:
+            continue
+
+        key = search_key(path[len(directory):-4])
+        for trigram in _trigrams(key):
+            index[trigram].append(len(records))
+        for word in _words(tags):
+            words[word.encode("utf-8", "surrogateescape")].append(len(records))
+
+        fields = [add_string(path), add_string(key)] + \
+            [add_string(tags[field]) for field in FIELDS[2:]]
+        records.append(RECORD.pack(*(value for field in fields for value in field),
+                                   tags["duration"], *_offsets(path, identity, tags["duration"], silence), *identity))
+
+    trigrams, postings = array("I"), array("I")
+    for trigram in sorted(index):
+        trigrams.extend((trigram, len(postings), len(index[trigram])))
+        postings.extend(index[trigram])
+
+    # words sorted by their bytes, so those sharing a prefix are together
+    word_table, word_postings = array("I"), array("I")
+    for word in sorted(words):
+        word_table.extend((len(strings), len(word), len(word_postings), len(words[word])))
+        strings.extend(word)
+        word_postings.extend(words[word])
+
+    os.makedirs(os.path.dirname(file) or ".", exist_ok=True)
+    temporary = f"{file}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as catalog_file:
+        catalog_file.write(HEADER.pack(MAGIC, len(records), len(trigrams) // 3, len(postings),
+                                       len(word_table) // 4, len(word_postings), directory_mtime))
+        catalog_file.write(b"".join(records))
+        catalog_file.write(trigrams.tobytes())
+        catalog_file.write(postings.tobytes())
+        catalog_file.write(word_table.tobytes())
+        catalog_file.write(word_postings.tobytes())
+        catalog_file.write(strings)
+    os.replace(temporary, file)
+
+    catalog_build_time.observe(time.perf_counter() - started)
+
+
+class Catalog:
+    """Read-only view of a catalog file
+
+    Lookups read straight from the mapping, only strings which are
+    asked for are copied out.
+    """
+
+    def __init__(self, file):
+
+        with open(file, "rb") as catalog_file:
+            stat = os.fstat(catalog_file.fileno())
+            self.mmap = mmap.mmap(catalog_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.file = file
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+        self.checked = time.monotonic()
+
+        try:
+            magic, self.count, trigram_count, posting_count, word_count, word_posting_count, \
+                self.directory_mtime = HEADER.unpack_from(self.mmap)
+        except struct.error:
+            magic = None
+        if magic != MAGIC:
+            raise CatalogError(f"{file} is not a catalog")
+
+        view = memoryview(self.mmap)
+        self._records = HEADER.size
+        trigrams = self._records + self.count * RECORD.size
+        postings = trigrams + trigram_count * 12
+        words = postings + posting_count * 4
+        word_postings = words + word_count * 16
+        self._strings = word_postings + word_posting_count * 4
+
+        self._trigrams = view[trigrams:postings].cast("I")
+        self._postings = view[postings:words].cast("I")
+        self._trigram_count = trigram_count
+        self._words = view[words:word_postings].cast("I")
+        self._word_postings = view[word_postings:self._strings].cast("I")
+        self._word_count = word_count
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, record, field):
+        offset, length = record[field * 2], record[field * 2 + 1]
+        start = self._strings + offset
+        return self.mmap[start:start + length].decode("utf-8", "surrogateescape")
+
+    def _record(self, index):
+        return RECORD.unpack_from(self.mmap, self._records + index * RECORD.size)
+
+    def path(self, index):
+        return self._string(self._record(index), 0)
+
+    def key(self, index):
+        return self._string(self._record(index), 1)
+
+    def tags(self, index):
+        """Returns a dict of the title, artist, album, date, duration and start and end offsets of a track"""
+        record = self._record(index)
+        tags = {field: self._string(record, number)
+                for number, field in enumerate(FIELDS) if number > 1}
+        tags["duration"], tags["start"], tags["end"] = record[12:15]
+        return tags
+
+    def identity(self, index):
+        """Returns the mtime and size of a track's file when it was read"""
+        return tuple(self._record(index)[15:])
+
+    def changed(self):
+        """Returns whether any file in the catalog has been changed or removed since it was read"""
+        for index in range(self.count):
+            try:
+                stat = os.stat(self.path(index))
+            except OSError:
+                return True
+            if (stat.st_mtime_ns, stat.st_size) != self.identity(index):
+                return True
+        return False
+
+    def _postings_for(self, trigram):
+        """Returns the tracks containing a trigram"""
+        low, high = 0, self._trigram_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._trigrams[middle * 3] < trigram:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._trigram_count and self._trigrams[low * 3] == trigram:
+            start, length = self._trigrams[low * 3 + 1], self._trigrams[low * 3 + 2]
+            return self._postings[start:start + length]
+        return ()
+
+    def search(self, query, *, limit=None, cutoff=0.1):
+        """Returns the indexes of the tracks closest to a query
+
+        Tracks sharing the most trigrams with the query, for their length,
+        are ranked with the same similarity ratio as
+        :func:`difflib.get_close_matches`.
+        """
+        limit = limit or SEARCH_RESULT_LIMIT
+        query = search_key(query)
+        query_length = len(query.encode("utf-8"))  # key lengths are stored in bytes
+
+        shared = collections.Counter()
+        for trigram in _trigrams(query):
+            shared.update(self._postings_for(trigram))
+        # scaled by length so long keys don't crowd out close matches
+        candidates = heapq.nlargest(limit * CATALOG_SEARCH_CANDIDATES, shared,
+                                    key=lambda index: shared[index] / (query_length + self._record(index)[3]))
+        if len(candidates) < limit:
+            candidates = range(self.count)
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(query)
+        results = list()
+        for index in candidates:
+            matcher.set_seq1(self.key(index))
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                ratio = matcher.ratio()
+                if ratio >= cutoff:
+                    results.append((ratio, index))
+
+        return [index for ratio, index in heapq.nlargest(limit, results)]
+
+    def _word(self, number):
+        start = self._strings + self._words[number * 4]
+        return self.mmap[start:start + self._words[number * 4 + 1]]
+
+    def _word_range(self, prefix):
+        """Returns the range of word numbers starting with a prefix"""
+        prefix = prefix.encode("utf-8", "surrogateescape")
+        words = _WordList(self)
+        # no utf-8 sequence contains 0xff so every word with the prefix sorts before this
+        return bisect.bisect_left(words, prefix), bisect.bisect_left(words, prefix + b"\xff")
+
+    def _word_tracks(self, low, high):
+        """Returns the set of tracks containing the words in a range"""
+        tracks = set()
+        for number in range(low, high):
+            start, length = self._words[number * 4 + 2], self._words[number * 4 + 3]
+            tracks.update(self._word_postings[start:start + length])
+        return tracks
+
+    def complete(self, text, *, limit=None):
+        """Returns the indexes of tracks with a word in their title or artist starting with every word of text
+
+        Shorter titles come first, as they are the closer completions.
+        """
+        matches = None
+        for prefix in sorted(search_key(text).split(), key=len, reverse=True):
+            tracks = self._word_tracks(*self._word_range(prefix))
+            matches = tracks if matches is None else matches & tracks
+            if not matches:
+                return []
+
+        return heapq.nsmallest(limit or SEARCH_RESULT_LIMIT, matches or (),
+                               key=lambda index: (self._record(index)[5], index))
+
+    def suggest(self, word, *, limit=3):
+        """Returns the words in the catalog closest to one starting no other word
+
+        Candidates share the longest prefix of the word which any catalog
+        word starts with, so only a small part of the index is compared.
+        """
+        key = search_key(word).strip()
+        for length in range(len(key), 0, -1):
+            low, high = self._word_range(key[:length])
+            if low == high:
+                continue
+            if length == len(key):
+                return []  # already the start of a word
+
+            candidates = [self._word(number).decode("utf-8", "surrogateescape")
+                          for number in range(low, min(high, low + CATALOG_SUGGEST_CANDIDATES))]
+            return difflib.get_close_matches(key, candidates, n=limit, cutoff=0.5)
+        return []
+
+    def did_you_mean(self, text):
+        """Returns text with each word no track starts a word with replaced by the closest catalog word, or None"""
+        words = search_key(text).split()
+        corrected = list()
+        for word in words:
+            suggestions = self.suggest(word, limit=1)
+            corrected.append(suggestions[0] if suggestions else word)
+        if corrected == words:
+            return None
+        return " ".join(corrected)
+
+
+class _WordList:
+    """Sequence of a catalog's sorted words for :mod:`bisect`"""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __len__(self):
+        return self.catalog._word_count
+
+    def __getitem__(self, number):
+        return self.catalog._word(number)
+
+
+_catalogs = dict()
+_catalogs_lock = threading.Lock()
+
+
+def _catalog_name(directory):
+    return hashlib.sha1(directory.encode("utf-8", "surrogateescape")).hexdigest()[:16]
+
+
+def catalog_file(directory):
+    """Returns the catalog file used for a directory"""
+    return os.path.join(CATALOG_DIRECTORY, f"{_catalog_name(directory)}.catalog")
+
+
+def silence_file(directory):
+    """Returns the file silence analysis of a directory is kept in"""
+    return os.path.join(CATALOG_DIRECTORY, f"{_catalog_name(directory)}.silence")
+
+
+def _load(directory, file, directory_mtime):
+    """Opens a directory's catalog, building it if it is missing or out of date"""
+    try:
+        catalog = Catalog(file)
+        if catalog.directory_mtime == directory_mtime and not catalog.changed():
+            return catalog
+    except (OSError, CatalogError):
+        pass
+
+    # only one process builds, the rest wait and use its catalog
+    with open(f"{file}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            catalog = Catalog(file)
+            if catalog.directory_mtime == directory_mtime and not catalog.changed():
+                return catalog
+        except (OSError, CatalogError):
+            pass
+
+        build_catalog(directory, file)
+        return Catalog(file)
+
+
+def open_catalog(directory):
+    """Returns the catalog for a directory
+
+    Catalogs are rebuilt when files in the directory are added, removed
+    or changed, as when they are retagged, and reopened when another
+    process replaces them. This may
+    block while a catalog is built, so call it from an executor.
+    """
+    directory = os.path.realpath(directory)
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(directory, None)
+        if catalog is not None and time.monotonic() - catalog.checked < CATALOG_CHECK_INTERVAL:
+            return catalog
+
+        os.makedirs(CATALOG_DIRECTORY, exist_ok=True)
+        file = catalog_file(directory)
+        directory_mtime = os.stat(directory).st_mtime_ns
+        try:
+            stat = os.stat(file)
+            file_id = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            file_id = None
+
+        if catalog is None or catalog.file_id != file_id or catalog.directory_mtime != directory_mtime \
+                or catalog.changed():
+            # the old catalog stays mapped until nothing refers to it
+            catalog = _load(directory, file, directory_mtime)
+
+        catalog.checked = time.monotonic()
+        _catalogs[directory] = catalog
+        return catalog
+
+
+def rebuild_catalog(directory):
+    """Rebuilds the catalog for a directory whether or not it has changed
+
+    Processes with the catalog open pick up the new one when they next
+    check for changes.
+    """
+    directory = os.path.realpath(directory)
+    os.makedirs(CATALOG_DIRECTORY, exist_ok=True)
+    file = catalog_file(directory)
+    with open(f"{file}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        build_catalog(directory, file)
@@ -9,7 +9,7 @@ Copyright (c) 2017 Joshua Butt
 
 import json
 
-from os import path
+from os import cpu_count, environ, path
 
 
 # Default player config
@@ -17,19 +17,111 @@ DEFAULT_PLAYLIST_DIRECTORY = "lib/mp3"
 DEFAULT_CACHE_LENGTH = 10
 DEFAULT_VOLUME = 0.15
 
+# Log channel config
+LOG_CHANNEL_INTERVAL = 2  # seconds between posts to a log channel
+LOG_CHANNEL_BATCH_SIZE = 5
+LOG_CHANNEL_QUEUE_LENGTH = 50
+LOG_CHANNEL_BACKOFF = 30  # seconds to wait after being rate limited
+
+# Request config
+REQUEST_LIMIT = 2  # requests a listener may have queued in advance
+IMPORT_REQUEST_LIMIT = 50  # requests an administrator may have queued via import
+IMPORT_WORKERS = 4  # concurrent track resolutions per import
+
+# Transcoder config
+TRANSCODER_LIMIT = 16  # concurrent ffmpeg processes across all sessions
+TRANSCODER_MONITOR_INTERVAL = 5
+TRANSCODER_CPU_LIMIT = 50  # percent of one core
+TRANSCODER_RSS_LIMIT = 256 * 1024 * 1024
+TRANSCODER_STRIKES = 3  # samples over the cpu limit before an ffmpeg process is killed
+TRANSCODER_NICENESS = 10
+TRANSCODER_PREFETCH_RESERVE = 4  # free slots kept for playback, the next track is only prefetched above this
+
+# Encoder config
+# - Sessions encode at their voice channel's bitrate, complexity falls from ENCODER_COMPLEXITY
+#   to ENCODER_MIN_COMPLEXITY as host cpu pressure rises from the low to the high pressure
+ENCODER_MAX_BITRATE = 128  # kbps
+ENCODER_COMPLEXITY = 10
+ENCODER_MIN_COMPLEXITY = 3
+ENCODER_PRESSURE_LOW = 0.1  # share of time tasks wait for a cpu
+ENCODER_PRESSURE_HIGH = 0.5
+ENCODER_POLICY_INTERVAL = 10
+
+# Read-ahead config
+# - Remote tracks are downloaded into a ring buffer ahead of ffmpeg, see read_ahead.py
+READ_AHEAD_BUFFER = 8 * 1024 * 1024  # bytes buffered per remote track, 0 lets ffmpeg read urls itself
+READ_AHEAD_TARGET = 256 * 1024  # bytes buffered before ffmpeg is fed, and again whenever it runs dry
+READ_AHEAD_TIMEOUT = 10
+READ_AHEAD_RETRIES = 5  # attempts to resume a dropped download without receiving anything
+
+# Voice reconnect config
+# - Sessions reconnect without restarting the current track, see Session.reconnect
+VOICE_RECONNECT_TIMEOUT = 10  # seconds allowed for each attempt to connect
+VOICE_RECONNECT_ATTEMPTS = 3
+VOICE_RECONNECT_DELAY = 1  # seconds before trying again, doubled after each failed attempt
+
+# Audio instrumentation config
+FRAME_STATS_WINDOW = 1500  # frames kept per session for percentiles, 30 seconds
+
+# Crossfade config
+# - The next track is opened while the current one plays and faded in over its last seconds
+CROSSFADE_SECONDS = float(environ.get("MP3BOT_CROSSFADE_SECONDS", 0))  # 0 turns crossfading off
+CROSSFADE_CURVE = "equal_power"  # "linear" or "equal_power"
+PREFETCH_TRACKS = CROSSFADE_SECONDS > 0  # keeps a second ffmpeg process open per session
+
+# Audio worker config
+# - Decoding, volume and Opus encoding for every session move to this many processes, 0 keeps them in the bot process
+AUDIO_WORKERS = int(environ.get("MP3BOT_AUDIO_WORKERS", 0))
+AUDIO_WORKER_BUFFER = 50  # frames buffered ahead of playback per stream, 1 second
+AUDIO_WORKER_OPEN_TIMEOUT = 10
+
+# Library catalog config
+# - Catalogs are shared by every process on the host, see catalog.py
+CATALOG_DIRECTORY = environ.get("MP3BOT_CATALOG_DIRECTORY", "lib/catalog")
+CATALOG_CHECK_INTERVAL = 30  # seconds between checks for library changes
+CATALOG_SEARCH_CANDIDATES = 20  # tracks ranked per search result, chosen by shared trigrams
+CATALOG_SUGGEST_CANDIDATES = 500  # words compared when suggesting a correction
+
+# Silence trimming config
+# - Offsets are found by running silence.py over a library and stored in its catalog
+SILENCE_THRESHOLD = -50  # dBFS below which audio counts as silence
+SILENCE_PADDING = 0.1  # seconds of silence kept before and after the audio
+SILENCE_SCAN_SECONDS = 15  # seconds analyzed at each end of a track
+SILENCE_WORKERS = cpu_count() or 1
+
 # Search result config
 SEARCH_RESULT_LIMIT = 5
+SEARCH_RESULT_TIMEOUT = 60
+SINGLEFLIGHT_MAX_WAITERS = 100  # callers allowed to share one in-flight request
+
+# Remote API config
+# - Each API host has a circuit breaker, retries and a stale-while-revalidate cache, see resilience.py
+UPSTREAM_TIMEOUT = 10  # seconds allowed for each call
+UPSTREAM_RETRIES = 2  # retries of server errors and timeouts
+UPSTREAM_BACKOFF = 0.25  # seconds, the most the first retry waits, doubling for each retry after
+UPSTREAM_BACKOFF_MAX = 4
+UPSTREAM_BREAKER_THRESHOLD = 5  # consecutive failures before a host's calls are failed fast
+UPSTREAM_BREAKER_TIMEOUT = 30  # seconds failing fast before a trial call, doubled after each failed trial
+UPSTREAM_BREAKER_TIMEOUT_MAX = 600
+UPSTREAM_QUOTA_TIMEOUT = 900  # seconds failing fast once an API's quota is exceeded
+SEARCH_CACHE_TTL = 600  # seconds search results are fresh
+SEARCH_CACHE_MAX_AGE = 86400  # seconds stale results are served while they're refreshed, or the API is down
+SEARCH_CACHE_SIZE = 1000  # results cached per API host
 
 # Discord embed attachments
 ART_NOT_FOUND_FILE = "lib/img/art_not_found.png"
 YOUTUBE_LOGO_FILE = "lib/img/youtube.png"
 CLYP_LOGO_FILE = "lib/img/clyp.png"
+COVER_CACHE_SIZE = 32  # album covers kept in memory for repeated embeds
 
 # List of guilds to start bot on initially
 SESSIONS_FILE = path.dirname(__file__) + "/startup.json"
-INITIAL_SESSIONS = json.load(open(SESSIONS_FILE))
+INITIAL_SESSIONS = json.load(open(SESSIONS_FILE)) if path.isfile(SESSIONS_FILE) else list()
 
 # Config for search
+# - API base URLs can be pointed at local mock servers, see benchmarks/mock_api.py
+YOUTUBE_API_URL = environ.get("MP3BOT_YOUTUBE_API_URL", "https://www.googleapis.com")
+CLYP_API_URL = environ.get("MP3BOT_CLYP_API_URL", "https://api.clyp.it")
 YOUTUBE_API_SERVICE_NAME = "youtube"
 YOUTUBE_API_VERSION = "v3"
 # - Make sure you generate you're own ID for your bot
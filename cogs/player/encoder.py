@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/encoder.py
+Opus encoder settings
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import os
+
+import discord
+
+from ..utils.metrics import registry
+from .config import *
+
+__all__ = [
+    "EncoderPolicy",
+
+    "configure_encoder",
+    "cpu_pressure",
+    "encoder_time"
+]
+
+CTL_SET_COMPLEXITY = 4010  # not wrapped by discord.py
+
+encoder_time = registry.counter(
+    "player_encoder_seconds_total", "Time spent Opus encoding audio frames", ["complexity"])
+
+
+def cpu_pressure():
+    """Returns the share of the last 10 seconds tasks on the host spent waiting for a cpu
+
+    Where the kernel doesn't report pressure it's estimated from the
+    load average.
+    """
+    try:
+        with open("/proc/pressure/cpu") as pressure:
+            some = pressure.readline().split()  # some avg10=0.00 avg60=0.00 avg300=0.00 total=0
+        return float(some[1].split("=")[1]) / 100
+    except (OSError, IndexError, ValueError):
+        load = os.getloadavg()[0]
+        return max(1 - (os.cpu_count() or 1) / load, 0) if load else 0
+
+
+def configure_encoder(encoder, bitrate, complexity):
+    """Applies settings to a :class:`discord.opus.Encoder`
+
+    Call this from the thread which encodes with it.
+    """
+    encoder.set_bitrate(bitrate)
+    discord.opus._lib.opus_encoder_ctl(
+        encoder._state, CTL_SET_COMPLEXITY, complexity)
+
+
+class EncoderPolicy:
+    """Chooses the Opus encoder settings of a session
+
+    The bitrate follows the voice channel's, as listeners receive no
+    more than that. Complexity is lowered as the host comes under cpu
+    pressure, so more sessions fit before frames are late.
+    """
+
+    def __init__(self):
+        self.bitrate = ENCODER_MAX_BITRATE
+        self.complexity = ENCODER_COMPLEXITY
+
+    @property
+    def settings(self):
+        return self.bitrate, self.complexity
+
+    def update(self, channel_bitrate, pressure):
+        """Updates the settings, returning True if they changed"""
+        bitrate = min(max(channel_bitrate // 1000, 16), ENCODER_MAX_BITRATE)
+
+        degraded = (pressure - ENCODER_PRESSURE_LOW) / \
+            (ENCODER_PRESSURE_HIGH - ENCODER_PRESSURE_LOW)
+        complexity = round(ENCODER_COMPLEXITY - min(max(degraded, 0), 1)
+                           * (ENCODER_COMPLEXITY - ENCODER_MIN_COMPLEXITY))
+
+        changed = (bitrate, complexity) != self.settings
+        self.bitrate, self.complexity = bitrate, complexity
+        return changed
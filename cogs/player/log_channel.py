@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/log_channel.py
+Discord mp3 player log channel poster
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import asyncio
+
+import discord
+
+from .config import *
+
+__all__ = [
+    "LogChannel"
+]
+
+
+class LogChannel:
+    """Fire-and-forget poster for a session's log channel
+
+    Payloads are queued and sent by a background task so that callers
+    never wait on the Discord API. Payloads which pile up while the
+    channel is being rate limited are collapsed into a single message.
+    """
+
+    def __init__(self, bot, channel, *, interval=None, batch_size=None):
+
+        self.bot = bot
+        self.channel = channel
+
+        self.interval = interval or LOG_CHANNEL_INTERVAL
+        self.batch_size = batch_size or LOG_CHANNEL_BATCH_SIZE
+
+        self.queue = asyncio.Queue(maxsize=LOG_CHANNEL_QUEUE_LENGTH)
+        self.task = self.bot.loop.create_task(self._poster_task())
+
+    def post(self, payload):
+        """Queues a message payload to be sent to the log channel"""
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.bot.log.warning(
+                f"Log channel queue full, dropping message for {self.channel}")
+
+    def stop(self):
+        """Stops posting to the log channel"""
+        self.task.cancel()
+
+    def _collapse(self, batch):
+        """Returns a single payload summarising a batch of payloads"""
+        payload = batch[-1]
+        if len(batch) > 1 and payload.get("embed") is not None:
+            titles = [p["embed"].title for p in batch[:-1]
+                      if p.get("embed") is not None]
+            # rendered embeds are shared with the track, so add to a copy
+            payload = dict(payload, embed=payload["embed"].copy())
+            payload["embed"].add_field(
+                name="Previously played", value="\n".join(titles) or "???", inline=False)
+        return payload
+
+    async def _send(self, payload):
+        """Sends a payload to the log channel"""
+        try:
+            await self.channel.send(**payload)
+        except discord.Forbidden as e:
+            self.bot.log.error(
+                "Failed to log current track to log_channel")
+            self.bot.log.error(f"{type(e).__name__}: {e}")
+        except discord.HTTPException as e:
+            self.bot.log.error(f"{type(e).__name__}: {e}")
+            if e.status == 429:
+                await asyncio.sleep(LOG_CHANNEL_BACKOFF)
+
+    async def _poster_task(self):
+        """Log channel's asyncio loop"""
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty() and len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+
+            await self._send(self._collapse(batch))
+            await asyncio.sleep(self.interval)
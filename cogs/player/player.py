@@ -8,43 +8,98 @@ Copyright (c) 2017 Joshua Butt
 """
 
 import asyncio
+import functools
+import io
+import time
 
-from glob import glob
+from array import array
 from random import shuffle
 from re import findall
 
 import discord
 from discord.ext import commands
 
+from ..utils.metrics import registry
+from .catalog import open_catalog
 from .config import *
+from .encoder import EncoderPolicy
+from .log_channel import LogChannel
+from .source import CrossfadeMixer, FrameStats, SessionSource, WorkerSessionSource
 from .track import *
+from .transcoder import PREFETCH
+
+
+stream_resolve_time = registry.histogram(
+    "player_stream_resolve_seconds", "Time taken to resolve a track's stream before playback")
+track_gap_time = registry.histogram(
+    "player_track_gap_seconds", "Time between a track ending and the next starting")
+voice_reconnect_time = registry.histogram(
+    "player_voice_reconnect_seconds", "Time taken to reconnect a session and carry on playing", ["result"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
 
 
 class Playlist:
-    """mp3 playlist object"""
+    """mp3 playlist object
+
+    ``catalog`` is the library catalog to play from, opened from an
+    executor. If ``loop`` is given the catalog is checked for changes in
+    an executor whenever the playlist has played through it.
+    """
 
-    def __init__(self, log, *, playlist_directory=None, cache_length=None):
+    def __init__(self, log, catalog, *, playlist_directory=None, cache_length=None, loop=None):
 
         self.log = log
+        self.loop = loop
         self.playlist_directory = playlist_directory or DEFAULT_PLAYLIST_DIRECTORY
 
-        self.tracks = self._get_tracks
+        self.catalog = catalog
+        self.tracks = self._shuffled_tracks()
         self.requests = list()
+        self.version = 0  # changed whenever the queue changes
+        self._refresh = None
         self.playlist = list(self._get_new_track for track in range(
             cache_length or DEFAULT_CACHE_LENGTH))
 
+    def _shuffled_tracks(self):
+        """Returns a shuffled array of indexes into the catalog"""
+        tracks = array("I", range(len(self.catalog)))
+        shuffle(tracks)
+        return tracks
+
     @property
     def _get_tracks(self):
-        """Returns a list of mp3 files in the playlist directory"""
-        files = glob(self.playlist_directory + "/*.mp3")
-        shuffle(files)
-        return files
+        """Returns a shuffled array of catalog indexes, checking the catalog for changes in the background"""
+        self._refresh_catalog()
+        return self._shuffled_tracks()
+
+    def _refresh_catalog(self):
+        if self.loop is None or self._refresh is not None:
+            return
+        self._refresh = self.loop.run_in_executor(
+            None, open_catalog, self.playlist_directory)
+        self._refresh.add_done_callback(self._catalog_refreshed)
+
+    def _catalog_refreshed(self, future):
+        self._refresh = None
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            e = future.exception()
+            self.log.error(
+                f"Failed to refresh library catalog: {type(e).__name__}: {e}")
+            return
+
+        catalog = future.result()
+        if catalog is not self.catalog:
+            # indexes into the old catalog mean nothing in the new one
+            self.catalog = catalog
+            self.tracks = self._shuffled_tracks()
 
     @property
     def _get_new_track(self):
         """Retruns the next item in the playlist as a :class:Mp3File"""
         try:
-            return Mp3File(self.log, self.tracks.pop(0))
+            return Mp3File.from_catalog(self.log, self.catalog, self.tracks.pop())
         except (IndexError, TrackError):
             self.tracks = self._get_tracks
             return self._get_new_track
@@ -57,6 +112,7 @@ class Playlist:
     @property
     def next_track(self):
         """Returns the next track"""
+        self.version += 1
         if self.requests:
             return self.requests.pop(0)
         self.playlist.append(self._get_new_track)
@@ -64,6 +120,7 @@ class Playlist:
 
     def add_request(self, request, *, front=False):
         """Adds the requested song to the playlist"""
+        self.version += 1
         if front:
             self.requests.insert(0, request)
         else:
@@ -75,6 +132,7 @@ class RequestPlaylist:
 
     def __init__(self):
         self.requests = list()
+        self.version = 0  # changed whenever the queue changes
 
     @property
     def queue(self):
@@ -84,6 +142,7 @@ class RequestPlaylist:
     @property
     def next_track(self):
         """Returns the next track"""
+        self.version += 1
         if self.requests:
             return self.requests.pop(0)
         else:
@@ -91,6 +150,7 @@ class RequestPlaylist:
 
     def add_request(self, request, *, front=False):
         """Adds the requested song to the playlist"""
+        self.version += 1
         if front:
             self.requests.insert(0, request)
         else:
@@ -109,6 +169,8 @@ class Session:
         self.guild = self.voice.guild
 
         self.log_channel = log_channel
+        self.log_poster = LogChannel(
+            self.bot, self.log_channel) if self.log_channel else None
         self.playlist = playlist or RequestPlaylist()
         self.permissions = permissions or dict()
 
@@ -120,6 +182,18 @@ class Session:
         self.volume = DEFAULT_VOLUME
 
         self.play_next_song = asyncio.Event()
+        self.frame_stats = FrameStats()
+        self.encoder_policy = EncoderPolicy()
+        # the voice client only makes an encoder once it plays a source which isn't Opus
+        self.encoder = discord.opus.Encoder() if discord.opus.is_loaded() else None
+        self._track_ended = None
+        self._queue_embed = (None, None)
+        self._prefetch = None  # the next track and the task opening its source
+        self.mixer = None
+        self.source = None  # the playing source, kept until its track ends
+        self._voice_lock = asyncio.Lock()  # held while starting a track or reconnecting
+        self._reconnecting = False
+        self._reconnect = None
 
         if playlist:
             self.player = self.bot.loop.create_task(self._player_task())
@@ -131,6 +205,26 @@ class Session:
             m.voice.self_deaf or m.voice.deaf)]
         return list(filter(self.voice.guild.me.__ne__, listeners))
 
+    @property
+    def queue_embed(self):
+        """Returns the upcoming tracks embed, rendered again only when the queue changes
+
+        The embed is shared between sends so must not be modified.
+        """
+        version, embed = self._queue_embed
+        if version != self.playlist.version:
+            embed = discord.Embed(
+                title=f"{self.bot.user.name} Playlist for {self.guild.name} - Upcoming songs:", description="", colour=0x004d40)
+            for track in self.playlist.queue:
+                embed.add_field(**track.queue, inline=False)
+            self._queue_embed = (self.playlist.version, embed)
+        return embed
+
+    @property
+    def position(self):
+        """Returns the seconds played of the current track"""
+        return self.source.position if self.source is not None else 0
+
     def start(self):
         """Starts the player"""
         self.is_playing = True
@@ -141,8 +235,34 @@ class Session:
         if error:
             self.bot.log.error(f"Error occured playing track: {error}")
         self.skip_requests = list()
+        self.source = None
+        self._track_ended = time.perf_counter()
         self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
 
+    def _finished(self, voice, error=None):
+        """Called from the audio thread when a voice client stops playing"""
+        if voice is not self.voice or self._reconnecting:
+            return  # the source has been moved to another connection
+        if self.is_playing and not voice.is_connected():
+            # the connection was lost rather than the track ending
+            self.bot.loop.call_soon_threadsafe(self._reconnect_dropped)
+            return
+        self._toggle_next(error)
+
+    def _reconnect_dropped(self):
+        if self.is_playing:
+            self.bot.loop.create_task(self.reconnect())
+
+    def add_request(self, track, *, front=False):
+        """Adds a track to the playlist, prefetching it if it plays next"""
+        self.playlist.add_request(track, front=front)
+        self._prefetch_next()
+
+    def update_encoder(self):
+        """Applies the encoder policy to the playing source if its settings have changed"""
+        if self.encoder_policy.update(self.voice.channel.bitrate, self.cog.cpu_pressure) and self.voice.source is not None:
+            self.voice.source.configure(*self.encoder_policy.settings)
+
     def change_volume(self, volume):
         """Changes the player's volume"""
         self.volume = volume
@@ -153,22 +273,190 @@ class Session:
         self.is_playing = False
         self.voice.stop()
 
-    async def _play_track(self, track):
-        """Plays the specified track"""
+    async def _play_track(self, track, *, position=0):
+        """Plays the specified track, from a number of seconds in if resuming it"""
+        self.current_track = track
+        # a resumed track was already prefetched, the next track is prefetched again for the new mixer
+        source = self._claim_prefetch(None if position else track)
+
+        if source is None:
+            try:
+                with stream_resolve_time.time():
+                    await self.current_track.resolve(self.bot.loop)
+            except Exception as e:
+                self._toggle_next(e)
+                return
+
+        # Log track to log_channel without delaying playback
+        if self.log_poster and self.is_playing and not position:
+            self.log_poster.post(self.current_track.playing_embed)
+
+        if source is None:
+            source = await self.cog.transcoders.open(self.current_track, self.guild,
+                                                     volume=self.volume, position=position)
+        if self.cog.transcoders.audio_workers is not None:
+            # worker frames are already encoded so can't be mixed, and
+            # a prefetched source may have been opened at another volume
+            source.set_volume(self.volume)
+            self.mixer = None
+            player = WorkerSessionSource(
+                source, self.volume, stats=self.frame_stats)
+        else:
+            self.mixer = CrossfadeMixer(source, position=position)
+            player = SessionSource(
+                self.mixer, self.volume, encoder=self.encoder, stats=self.frame_stats)
+        self.encoder_policy.update(
+            self.voice.channel.bitrate, self.cog.cpu_pressure)
+        player.configure(*self.encoder_policy.settings)
+        self.source = player
+        try:
+            self.voice.play(source=player, after=functools.partial(
+                self._finished, self.voice))
+        except Exception as e:
+            # the after callback won't run, so nothing else would release the transcoder
+            player.cleanup()
+            if self.is_playing and not self.voice.is_connected() and not self._reconnecting:
+                # the connection dropped since the track was opened, reopen it once reconnected
+                self._reconnect_dropped()
+            else:
+                self._toggle_next(e)
+            return
+
+        if self._track_ended is not None:
+            track_gap_time.observe(time.perf_counter() - self._track_ended)
+            self._track_ended = None
+        self._prefetch_next()
+
+    def _crossfaded(self, track):
+        """Moves on to a track the mixer has started fading in"""
+        if self._prefetch is not None and self._prefetch[0] is track:
+            self._prefetch = None
+        queue = self.playlist.queue
+        if queue and queue[0] is track:
+            self.playlist.next_track  # removes it from the queue
+
         self.current_track = track
+        self.skip_requests = list()
+        if self.log_poster and self.is_playing:
+            self.log_poster.post(self.current_track.playing_embed)
+        self._prefetch_next()
+
+    def _is_next(self, track):
+        queue = self.playlist.queue
+        return bool(queue) and queue[0] is track
+
+    async def _open_ahead(self, track):
+        await track.resolve(self.bot.loop)
+        return await self.cog.transcoders.open(track, self.guild, priority=PREFETCH, volume=self.volume)
+
+    def _prefetch_next(self):
+        """Starts opening the next track's source so it can follow the current one without a gap"""
+        queue = self.playlist.queue
+        track = queue[0] if queue else None
+        if self._prefetch is not None and self._prefetch[0] is track:
+            return
+        self._claim_prefetch(None)  # discards the prefetch of a track no longer next
+
+        if track is None or not PREFETCH_TRACKS or not self.is_playing or not self.cog.transcoders.can_prefetch:
+            return
+        task = self.bot.loop.create_task(self._open_ahead(track))
+        self._prefetch = (track, task)
+        if self.mixer is not None:
+            task.add_done_callback(
+                functools.partial(self._offer_prefetch, self.mixer, track))
+
+    def _offer_prefetch(self, mixer, track, task):
+        """Offers a prefetched source to the mixer to fade in"""
+        if self._prefetch is None or self._prefetch[1] is not task or mixer is not self.mixer:
+            return
+        if task.cancelled() or task.exception() is not None:
+            return
+        mixer.offer(task.result(), check=functools.partial(self._is_next, track),
+                    started=functools.partial(self.bot.loop.call_soon_threadsafe, self._crossfaded, track))
+
+    def _claim_prefetch(self, track):
+        """Returns the prefetched source for a track, discarding any other prefetch"""
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is None:
+            return None
 
-        # Log track to log_channel
-        if self.log_channel and self.is_playing:
+        prefetched_track, task = prefetch
+        if not task.done():
+            task.cancel()
+            return None
+        if task.cancelled() or task.exception() is not None:
+            return None
+
+        source = task.result()
+        if self.mixer is not None and not self.mixer.withdraw(source):
+            return None  # the mixer has already started it
+        if prefetched_track is track:
+            return source
+        source.cleanup()
+        return None
+
+    async def reconnect(self):
+        """Reconnects to the voice channel, carrying on from the same point in the current track
+
+        The playing source is moved to the new connection along with
+        whatever it has buffered. If it has already been cleaned up, as
+        when the connection was lost, the track is reopened where it got to.
+        """
+        if self._reconnect is None or self._reconnect.done():
+            self._reconnect = self.bot.loop.create_task(self._reconnect_task())
+        await asyncio.shield(self._reconnect)
+
+    async def _reconnect_task(self):
+        started = time.perf_counter()
+        async with self._voice_lock:
+            self._reconnecting = True
             try:
-                await self.log_channel.send(**self.current_track.playing_embed)
-            except discord.Forbidden as e:
-                self.bot.log.error(
-                    "Failed to log current track to log_channel")
-                self.bot.log.error(f"{type(e).__name__}: {e}")
+                result = await self._reconnect_voice()
+            finally:
+                self._reconnecting = False
+        voice_reconnect_time.observe(time.perf_counter() - started, result)
 
-        player = discord.PCMVolumeTransformer(
-            self.current_track.player, self.volume)
-        self.voice.play(source=player, after=self._toggle_next)
+        if result == "failed":
+            self.play_next_song.set()
+        else:
+            await self.check_voice_state()
+
+    async def _reconnect_voice(self):
+        """Replaces the voice client, returning how playback carried on"""
+        channel = self.voice.channel
+        player = None
+        if self.voice.is_playing() or self.voice.is_paused():
+            player = self.voice.source
+            # the old connection's player ends with an empty source instead
+            self.voice.source = discord.PCMAudio(io.BytesIO())
+        await self.voice.disconnect(force=True)
+
+        for attempt in range(VOICE_RECONNECT_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(VOICE_RECONNECT_DELAY * 2 ** (attempt - 1))
+            try:
+                self.voice = await channel.connect(timeout=VOICE_RECONNECT_TIMEOUT)
+                break
+            except (asyncio.TimeoutError, discord.ClientException) as e:
+                self.bot.log.warning(
+                    f"Failed to reconnect to {channel} in {self.guild}: {type(e).__name__}: {e}")
+        else:
+            self.bot.log.error(
+                f"Giving up reconnecting to {channel} in {self.guild}")
+            if player is not None:
+                player.cleanup()
+            self.is_playing = False
+            return "failed"
+
+        if player is not None:
+            player.clock.reset()
+            self.voice.play(source=player, after=functools.partial(
+                self._finished, self.voice))
+            return "resumed"
+        if self.source is not None:
+            await self._play_track(self.current_track, position=self.position)
+            return "reopened"
+        return "idle"
 
     async def check_voice_state(self):
         """Checks wether the player should be paused or resumed"""
@@ -186,10 +474,16 @@ class Session:
             self.play_next_song.clear()
             next_track = self.playlist.next_track
             if next_track is not None:
-                await self._play_track(next_track)
+                async with self._voice_lock:
+                    await self._play_track(next_track)
                 await self.check_voice_state()
                 await self.play_next_song.wait()
             else:
                 self.stop()
+        self._claim_prefetch(None)
+        if self.log_poster:
+            self.log_poster.stop()
         await self.voice.disconnect()
-        del self.cog.sessions[self.guild]
\ No newline at end of file
+        # a restarted session may already have replaced this one
+        if self.cog.sessions.get(self.guild.id, None) is self:
+            del self.cog.sessions[self.guild.id]
\ No newline at end of file
@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/read_ahead.py
+Read-ahead buffering for remote tracks
+
+Remote streams are downloaded by a thread into a bounded ring buffer and
+ffmpeg is fed from it through its stdin pipe, so a network hiccup drains
+the buffer rather than starving the voice thread.
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import http.client
+import threading
+import time
+import urllib.error
+import urllib.request
+import weakref
+
+import discord
+
+from ..utils.metrics import registry
+from .config import *
+
+__all__ = [
+    "ReadAhead",
+    "ReadAheadAudio",
+
+    "ffmpeg_source"
+]
+
+_streams = weakref.WeakSet()
+
+read_ahead_underruns = registry.counter(
+    "player_read_ahead_underruns_total", "Times ffmpeg was left waiting on a remote track's download")
+read_ahead_retries = registry.counter(
+    "player_read_ahead_retries_total", "Dropped remote track downloads which were resumed")
+read_ahead_fill_time = registry.histogram(
+    "player_read_ahead_fill_seconds", "Time taken to fill a read-ahead buffer to its target depth",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+
+def _health():
+    streams = list(_streams)
+    downloading = [stream for stream in streams if not stream.done]
+    return {
+        ("streams",): len(streams),
+        ("downloading",): len(downloading),
+        ("buffered_bytes",): sum(stream.length for stream in streams),
+        # the closest any download is to running dry, 1 when none are
+        ("min_fill_ratio",): min((stream.length / stream.capacity for stream in downloading), default=1)
+    }
+
+
+registry.gauge("player_read_ahead_buffer", "Health of remote track read-ahead buffers", ["measure"],
+               function=_health)
+
+
+class ReadAhead:
+    """Bounded ring buffer filled from a remote stream by a download thread
+
+    The network is read straight into the ring. Once ``target`` bytes are
+    buffered, or the download finishes, :meth:`read` hands them to
+    discord.py's stdin writer for ffmpeg. If the buffer runs dry it is
+    filled to the target again before more is handed over. Dropped
+    connections are resumed from where they stopped with range requests.
+    """
+
+    def __init__(self, url, *, capacity=None, target=None):
+
+        self.url = url
+        self.buffer = bytearray(capacity or READ_AHEAD_BUFFER)
+        self.capacity = len(self.buffer)
+        self.target = min(target or READ_AHEAD_TARGET, self.capacity)
+
+        self.start = 0  # offset of the first buffered byte
+        self.length = 0  # bytes buffered
+        self.received = 0  # bytes downloaded
+        self.underruns = 0
+        self.done = False
+        self.closed = False
+        self.error = None
+
+        self._view = memoryview(self.buffer)
+        self._filling = True
+        self._fill_started = time.perf_counter()
+        self._condition = threading.Condition()
+        self._response = None
+        self._thread = threading.Thread(
+            target=self._download, daemon=True, name="read-ahead")
+
+    def open(self):
+        """Starts downloading"""
+        _streams.add(self)
+        self._thread.start()
+        return self
+
+    def _writable(self):
+        """Waits for free space, returning a view of the largest run of it or None once closed"""
+        with self._condition:
+            while self.length == self.capacity and not self.closed:
+                self._condition.wait()
+            if self.closed:
+                return None
+            end = (self.start + self.length) % self.capacity
+            return self._view[end:end + min(self.capacity - self.length, self.capacity - end)]
+
+    def _commit(self, count):
+        with self._condition:
+            self.length += count
+            self.received += count
+            if self._filling and self.length >= self.target:
+                self._filled()
+            self._condition.notify_all()
+
+    def _filled(self):
+        self._filling = False
+        read_ahead_fill_time.observe(time.perf_counter() - self._fill_started)
+
+    def _fetch(self):
+        """Downloads from the first byte not yet received until the stream ends or the buffer is closed"""
+        headers = {"Range": f"bytes={self.received}-"} if self.received else {}
+        with urllib.request.urlopen(urllib.request.Request(self.url, headers=headers),
+                                    timeout=READ_AHEAD_TIMEOUT) as response:
+            self._response = response
+            # servers ignoring the range send everything again
+            skip = self.received if response.status != 206 else 0
+            while True:
+                view = self._writable()
+                if view is None:
+                    return
+                if skip:
+                    view = view[:skip]
+                count = response.readinto(view)
+                if not count:
+                    if response.length:  # the connection closed early
+                        raise http.client.IncompleteRead(b"", response.length)
+                    return
+                if skip:
+                    skip -= count
+                else:
+                    self._commit(count)
+
+    def _download(self):
+        attempt = 0
+        try:
+            while not self.closed:
+                received = self.received
+                try:
+                    self._fetch()
+                    return
+                except urllib.error.HTTPError as e:
+                    if e.code < 500:  # won't be any different next time
+                        self.error = e
+                        return
+                    error = e
+                except (OSError, http.client.HTTPException) as e:
+                    error = e
+
+                attempt = 0 if self.received > received else attempt + 1
+                if self.closed or attempt > READ_AHEAD_RETRIES:
+                    self.error = error
+                    return
+                read_ahead_retries.inc()
+                with self._condition:
+                    self._condition.wait(min(0.25 * 2 ** attempt, 5))
+        finally:
+            with self._condition:
+                self.done = True
+                if self._filling:
+                    self._filled()
+                self._condition.notify_all()
+
+    def read(self, size=-1):
+        """Returns up to ``size`` buffered bytes, waiting for them if needed, or b"" at the end"""
+        with self._condition:
+            if not self.length and not self.done and not self._filling:
+                # ran dry, refill to the target before carrying on
+                self.underruns += 1
+                read_ahead_underruns.inc()
+                self._filling = True
+                self._fill_started = time.perf_counter()
+
+            while self._filling and not self.done and not self.closed:
+                self._condition.wait()
+            if self.closed or not self.length:
+                return b""
+
+            count = min(self.length, self.capacity - self.start)
+            if size is not None and size >= 0:
+                count = min(count, size)
+            data = bytes(self._view[self.start:self.start + count])
+            self.start = (self.start + count) % self.capacity
+            self.length -= count
+            self._condition.notify_all()
+            return data
+
+    def close(self):
+        """Stops downloading and ends reads"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        response = self._response
+        if response is not None:
+            try:
+                response.close()  # interrupts a blocked read
+            except Exception:
+                pass
+        _streams.discard(self)
+
+
+class ReadAheadAudio(discord.FFmpegPCMAudio):
+    """:class:`discord.FFmpegPCMAudio` piped from a :class:`ReadAhead` of a url"""
+
+    def __init__(self, source, **kwargs):
+
+        self.read_ahead = ReadAhead(source).open()
+        try:
+            super().__init__(self.read_ahead, pipe=True, **kwargs)
+        except BaseException:
+            self.read_ahead.close()
+            raise
+
+    def cleanup(self):
+        self.read_ahead.close()
+        super().cleanup()
+
+
+def ffmpeg_source(ffmpeg_input):
+    """Returns the audio source for keyword arguments from :meth:`Track.ffmpeg_input_at`
+
+    Inputs marked ``read_ahead`` are buffered by a :class:`ReadAhead` unless
+    it is turned off with a ``READ_AHEAD_BUFFER`` of 0.
+    """
+    ffmpeg_input = dict(ffmpeg_input)
+    if ffmpeg_input.pop("read_ahead", False) and READ_AHEAD_BUFFER:
+        return ReadAheadAudio(**ffmpeg_input)
+    return discord.FFmpegPCMAudio(**ffmpeg_input)
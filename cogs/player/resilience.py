@@ -0,0 +1,235 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/resilience.py
+Circuit breaking, retries and caching for remote APIs
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import asyncio
+import collections
+import random
+import time
+
+from ..utils.metrics import registry
+from .config import *
+
+__all__ = [
+    "CircuitBreaker",
+    "Upstream",
+
+    "UpstreamError",
+    "UpstreamUnavailable",
+
+    "upstreams"
+]
+
+upstreams = list()
+
+upstream_calls = registry.counter(
+    "player_upstream_calls_total", "Calls to remote APIs by result", ["upstream", "result"])
+upstream_cache = registry.counter(
+    "player_upstream_cache_total", "Remote API lookups by how the cache served them", ["upstream", "result"])
+registry.gauge("player_upstream_breaker_open", "Whether calls to a remote API are being failed fast", ["upstream"],
+               function=lambda: {(upstream.name,): int(upstream.breaker.is_open) for upstream in upstreams})
+
+
+class UpstreamError(Exception):
+    """Error response from a remote API
+
+    ``status`` is None if no response was received. If ``quota`` is set
+    the API has refused calls until its quota is replenished.
+    """
+
+    def __init__(self, message, *, status=None, quota=False):
+        super().__init__(message)
+        self.status = status
+        self.quota = quota
+
+    @property
+    def retryable(self):
+        return not self.quota and (self.status is None or self.status >= 500)
+
+
+class UpstreamUnavailable(Exception):
+    """"""
+    pass
+
+
+def backoff(attempt):
+    """Returns the delay before a retry, with full jitter"""
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Fails calls to a remote API fast while it keeps failing
+
+    The breaker opens after ``threshold`` consecutive failures, or at once
+    if a quota is exceeded. Once its timeout has passed one trial call is
+    let through, closing the breaker if it succeeds and reopening it for
+    twice as long if it fails.
+    """
+
+    def __init__(self, name, *, threshold=None, timeout=None):
+
+        self.name = name
+        self.threshold = threshold or UPSTREAM_BREAKER_THRESHOLD
+        self.timeout = timeout or UPSTREAM_BREAKER_TIMEOUT
+
+        self.failures = 0
+        self.open_for = 0
+        self.opened = None
+        self.trial = False
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    @property
+    def retry_in(self):
+        """Returns the seconds until a trial call is let through"""
+        return max(self.opened + self.open_for - time.monotonic(), 0) if self.is_open else 0
+
+    def check(self):
+        """Raises :class:`UpstreamUnavailable` unless a call may be made"""
+        if not self.is_open:
+            return
+        if self.trial or self.retry_in > 0:
+            retry_in = max(round(self.retry_in), 1)
+            raise UpstreamUnavailable(f"{self.name} is unavailable, try again in " + (
+                f"{retry_in} seconds" if retry_in < 120 else f"{retry_in // 60} minutes"))
+        self.trial = True
+
+    def success(self):
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    def failure(self, *, quota=False):
+        self.failures += 1
+        if quota:
+            self._open(UPSTREAM_QUOTA_TIMEOUT)
+        elif self.trial:
+            self._open(min(self.open_for * 2, UPSTREAM_BREAKER_TIMEOUT_MAX))
+        elif self.failures >= self.threshold and not self.is_open:
+            self._open(self.timeout)
+
+    def _open(self, timeout):
+        # jittered so breakers across workers don't all retry at once
+        self.open_for = timeout * random.uniform(0.9, 1.1)
+        self.opened = time.monotonic()
+        self.trial = False
+
+
+class Upstream:
+    """Calls to one remote API host
+
+    Results are cached by key. Fresh results are served from the cache,
+    stale ones are served while a call refreshes them in the background,
+    and served instead of an error if the API is down. Server errors and
+    timeouts are retried with jittered exponential backoff and calls fail
+    fast while the host's :class:`CircuitBreaker` is open.
+    """
+
+    def __init__(self, name, *, ttl=None, max_age=None, size=None):
+
+        self.name = name
+        self.ttl = ttl or SEARCH_CACHE_TTL
+        self.max_age = max_age or SEARCH_CACHE_MAX_AGE
+        self.size = size or SEARCH_CACHE_SIZE
+
+        self.breaker = CircuitBreaker(name)
+        self.cache = collections.OrderedDict()  # key to when it was fetched and the result
+        self._refreshing = set()
+
+        upstreams.append(self)
+
+    def _cached(self, key):
+        """Returns the age and result cached for a key, or None"""
+        cached = self.cache.get(key, None)
+        if cached is None:
+            return None
+        age = time.monotonic() - cached[0]
+        if age > self.max_age:
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return age, cached[1]
+
+    def _store(self, key, result):
+        self.cache[key] = (time.monotonic(), result)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    async def get(self, key, flight, function, *args):
+        """Returns the result of ``function(*args)`` for a key
+
+        Calls go through ``flight``, a :class:`SingleFlight`, so
+        concurrent lookups of a key share one call and its retries.
+        """
+        cached = self._cached(key)
+        if cached is not None:
+            age, result = cached
+            if age < self.ttl:
+                upstream_cache.inc(self.name, "fresh")
+            else:
+                upstream_cache.inc(self.name, "stale")
+                self._refresh(key, flight, function, *args)
+            return result
+
+        upstream_cache.inc(self.name, "miss")
+        return await flight.do(key, self.call, key, function, *args)
+
+    def _refresh(self, key, flight, function, *args):
+        """Refreshes a stale result in the background"""
+        if key in self._refreshing or self.breaker.is_open:
+            return
+        self._refreshing.add(key)
+
+        async def refresh():
+            try:
+                await flight.do(key, self.call, key, function, *args)
+            except Exception:
+                pass  # the stale result is served until the next refresh
+            finally:
+                self._refreshing.discard(key)
+        asyncio.ensure_future(refresh())
+
+    async def call(self, key, function, *args):
+        """Calls the API, caching and returning the result"""
+        for attempt in range(UPSTREAM_RETRIES + 1):
+            try:
+                self.breaker.check()
+            except UpstreamUnavailable:
+                upstream_calls.inc(self.name, "rejected")
+                raise
+
+            try:
+                result = await asyncio.wait_for(function(*args), UPSTREAM_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                quota = isinstance(e, UpstreamError) and e.quota
+                self.breaker.failure(quota=quota)
+                upstream_calls.inc(self.name, "quota" if quota else "error")
+
+                if isinstance(e, UpstreamError):
+                    retryable = e.retryable
+                else:
+                    retryable = isinstance(e, (asyncio.TimeoutError, OSError))
+                if not retryable or attempt == UPSTREAM_RETRIES:
+                    raise
+                await asyncio.sleep(backoff(attempt))
+                continue
+
+            self.breaker.success()
+            upstream_calls.inc(self.name, "ok")
+            self._store(key, result)
+            return result
+
+    def reset(self):
+        """Empties the cache and closes the breaker"""
+        self.cache.clear()
+        self.breaker.success()
@@ -8,14 +8,19 @@ Copyright (c) 2017 Joshua Butt
 """
 
 import aiohttp
-import difflib
+import asyncio
+import io
 import re
 
-from glob import glob
+from os import path
 
 import discord
 
+from ..utils.metrics import registry
+from .catalog import open_catalog
 from .config import *
+from .resilience import Upstream, UpstreamError, UpstreamUnavailable
+from .singleflight import SingleFlight, SingleFlightError
 from .track import *
 
 __all__ = [
@@ -24,15 +29,48 @@ __all__ = [
     "SearchError",
     "TrackError",
 
-    "search_types"
+    "search_types",
+    "import_track",
+    "search_flights",
+    "search_latency"
 ]
 
+search_latency = registry.histogram(
+    "player_search_seconds", "Search latency per search type", ["search"])
+
+youtube_api = Upstream("YouTube")
+clyp_api = Upstream("Clyp")
+
+# error reasons given by the YouTube API when calls are refused until the quota is replenished
+YOUTUBE_QUOTA_REASONS = {"quotaExceeded", "dailyLimitExceeded",
+                         "rateLimitExceeded", "userRateLimitExceeded"}
+
 
 class SearchError(Exception):
     """"""
     pass
 
 
+async def _get_json(url):
+    """Returns the JSON body of a GET request, raising :class:`UpstreamError` if it fails"""
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as resp:
+                try:
+                    data = await resp.json(content_type=None)
+                except ValueError:
+                    data = None
+                status = resp.status
+    except aiohttp.ClientError as e:
+        raise UpstreamError(f"{type(e).__name__}: {e}")
+
+    if status != 200:
+        errors = data.get("error", {}).get("errors", []) if isinstance(data, dict) else []
+        raise UpstreamError(f"{url.split('?')[0]} returned {status}", status=status,
+                            quota=status == 429 or any(error.get("reason") in YOUTUBE_QUOTA_REASONS for error in errors))
+    return data
+
+
 class Search:
     """Base class for various audio track types"""
 
@@ -48,19 +86,16 @@ class Mp3FileSearch(Search):
         self.log = log
         self.search_query = search_query
         self.requester = requester
-        self.files = dict()
         self.tracks = list()
 
     async def get(self):
-        for filename in glob(DEFAULT_PLAYLIST_DIRECTORY + "/*.mp3"):
-            search_term = filename[len(DEFAULT_PLAYLIST_DIRECTORY):-4]
-            search_term = re.sub(r"[^A-z\s]", '', search_term.lower())
-            self.files[search_term] = filename
+        catalog = await asyncio.get_event_loop().run_in_executor(
+            None, open_catalog, DEFAULT_PLAYLIST_DIRECTORY)
 
-        for search_term in difflib.get_close_matches(re.sub(r"[^A-z\s]", '', self.search_query.lower()), self.files, n=SEARCH_RESULT_LIMIT, cutoff=0.1):
+        for index in catalog.search(self.search_query, limit=SEARCH_RESULT_LIMIT):
             try:
-                self.tracks.append(
-                    Mp3File(self.log, self.files[search_term], requester=self.requester))
+                self.tracks.append(Mp3File.from_catalog(
+                    self.log, catalog, index, requester=self.requester))
             except TrackError:
                 pass
 
@@ -87,49 +122,69 @@ class YoutubeSearch(Search):
         self.requester = requester
         self.tracks = list()
 
-    async def get(self):
-
-        try:
-
-            videos = list()
-            youtube_api_url = f"https://www.googleapis.com/{YOUTUBE_API_SERVICE_NAME}/{YOUTUBE_API_VERSION}"
-            youtube_search_url = f"{youtube_api_url}/search?q={self.search_query}&part=snippet&maxResults=7&key={YOUTUBE_API_KEY}&alt=json"
-
-            async with aiohttp.ClientSession() as session:
-                async with session.get(youtube_search_url) as resp:
-
-                    data = await resp.json()
-                    for search_result in data["items"]:
-                        if search_result["id"]["kind"] == "youtube#video":
-                            videos.append(search_result["id"]["videoId"])
-
-            youtube_video_list_url = f"{youtube_api_url}/videos?part=snippet%2CcontentDetails&id={'%2C'.join(videos)}&key={YOUTUBE_API_KEY}&alt=json"
+    @staticmethod
+    async def _fetch(search_query):
+        """Returns the raw API results for a search query"""
+        videos = list()
+        youtube_api_url = f"{YOUTUBE_API_URL}/{YOUTUBE_API_SERVICE_NAME}/{YOUTUBE_API_VERSION}"
+        youtube_search_url = f"{youtube_api_url}/search?q={search_query}&part=snippet&maxResults=7&key={YOUTUBE_API_KEY}&alt=json"
+
+        data = await _get_json(youtube_search_url)
+        for search_result in data["items"]:
+            if search_result["id"]["kind"] == "youtube#video":
+                videos.append(search_result["id"]["videoId"])
+
+        return await YoutubeSearch._fetch_videos(videos)
+
+    @staticmethod
+    async def _fetch_videos(video_ids):
+        """Returns the raw API results for a list of video IDs, excluding long videos"""
+        results = list()
+        youtube_api_url = f"{YOUTUBE_API_URL}/{YOUTUBE_API_SERVICE_NAME}/{YOUTUBE_API_VERSION}"
+        youtube_video_list_url = f"{youtube_api_url}/videos?part=snippet%2CcontentDetails&id={'%2C'.join(video_ids)}&key={YOUTUBE_API_KEY}&alt=json"
+
+        data = await _get_json(youtube_video_list_url)
+        for search_result in data["items"]:
+            hour_length = re.search(
+                r"(\d+)H", search_result["contentDetails"]["duration"])
+            if hour_length:
+                continue
+
+            minute_length = re.search(
+                r"(\d+)M", search_result["contentDetails"]["duration"])
+            if minute_length is None or int(minute_length.groups()[0]) < 10:
+                results.append(search_result)
+
+        return results
 
-            async with aiohttp.ClientSession() as session:
-                async with session.get(youtube_video_list_url) as resp:
-
-                    data = await resp.json()
-                    for search_result in data["items"]:
-                        hour_length = re.search(
-                            r"(\d+)H", search_result["contentDetails"]["duration"])
-                        if hour_length:
-                            continue
-
-                        minute_length = re.search(
-                            r"(\d+)M", search_result["contentDetails"]["duration"])
-                        if minute_length is None or int(minute_length.groups()[0]) < 10:
-                            self.tracks.append(YoutubeVideo(
-                                self.log, search_result, self.requester))
+    async def get(self):
 
-            self.tracks = self.tracks[:SEARCH_RESULT_LIMIT]
+        video = re.search(
+            r"(?:youtu\.be\/|youtube\.com\/watch\?v=)([\w-]{11})", self.search_query)
 
+        try:
+            if video:
+                video_id = video.groups()[0]
+                results = await youtube_api.get(
+                    f"video:{video_id}", youtube_search_flight, self._fetch_videos, [video_id])
+            else:
+                results = await youtube_api.get(
+                    self.search_query.strip().lower(), youtube_search_flight, self._fetch, self.search_query)
+        except (SingleFlightError, UpstreamUnavailable) as e:
+            raise SearchError(str(e))
         except Exception as e:
+            if isinstance(e, UpstreamError) and e.quota:
+                raise SearchError(
+                    "The youtube API quota has been used up, try again later")
             self.log.error(
                 f"Error querying youtube API, likely bad API key")
             self.log.error(type(e).__name__ + ': ' + str(e))
             raise SearchError(
                 "Error querying youtube API, likely bad API key")
 
+        self.tracks = [YoutubeVideo(self.log, search_result, self.requester)
+                       for search_result in results[:SEARCH_RESULT_LIMIT]]
+
     @property
     def search_embed(self):
         track_list = ""
@@ -143,7 +198,7 @@ class YoutubeSearch(Search):
 
         return {
             "embed": embed,
-            "file": discord.File(open(YOUTUBE_LOGO_FILE, 'rb'), "youtube.png")
+            "file": discord.File(io.BytesIO(image(YOUTUBE_LOGO_FILE)), "youtube.png")
         }
 
 
@@ -155,6 +210,16 @@ class ClypSearch(Search):
         self.search_query = search_query
         self.requester = requester
 
+    @staticmethod
+    async def _fetch(track_id):
+        """Returns the raw API result for a track ID"""
+        try:
+            return await _get_json(f"{CLYP_API_URL}/{track_id}")
+        except UpstreamError as e:
+            if e.status == 404:
+                return None
+            raise
+
     async def get(self):
         track = re.search(
             r"(?:(?:clyp\.it\/)|^)([A-z\d]+)(?:$|\#)", self.search_query)
@@ -163,13 +228,19 @@ class ClypSearch(Search):
 
         self.track_id = track.groups()[0]
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://api.clyp.it/{self.track_id}") as resp:
-                if resp.status != 200:
-                    raise SearchError(
-                        "Unable to find clyp with given ID or URL")
+        try:
+            result = await clyp_api.get(
+                self.track_id, clyp_search_flight, self._fetch, self.track_id)
+        except (SingleFlightError, UpstreamUnavailable) as e:
+            raise SearchError(str(e))
+        except UpstreamError as e:
+            self.log.error(f"Error querying clyp API: {e}")
+            raise SearchError("Error querying clyp API, try again later")
+
+        if result is None:
+            raise SearchError("Unable to find clyp with given ID or URL")
 
-                self.tracks = [ClypTrack(self.log, await resp.json(), self.requester)]
+        self.tracks = [ClypTrack(self.log, result, self.requester)]
 
     @property
     def search_embed(self):
@@ -182,10 +253,58 @@ class ClypSearch(Search):
 
         return {
             "embed": embed,
-            "file": discord.File(open(CLYP_LOGO_FILE, 'rb'), "clyp.png")
+            "file": discord.File(io.BytesIO(image(CLYP_LOGO_FILE)), "clyp.png")
         }
 
 
+async def import_track(log, item, requester):
+    """Returns a track for a single item of a bulk import
+
+    Items may be Clyp or YouTube URLs, IDs marked with a ``clyp:`` or
+    ``yt:`` prefix, paths to files in the playlist directory or a query
+    for the local playlist.
+    """
+    item = item.strip()
+    prefix, _, track_id = item.partition(":")
+    prefix, track_id = prefix.strip().lower(), track_id.strip()
+
+    if re.search(r"clyp\.it\/", item):
+        search = ClypSearch(log, item, requester)
+    elif prefix == "clyp" and track_id:
+        search = ClypSearch(log, track_id, requester)
+    elif re.search(r"youtu\.be\/|youtube\.com\/", item):
+        search = YoutubeSearch(log, item, requester)
+    elif prefix == "yt" and track_id:
+        search = YoutubeSearch(log, f"https://youtu.be/{track_id}", requester)
+    elif item.lower().endswith(".mp3"):
+        directory = path.realpath(DEFAULT_PLAYLIST_DIRECTORY)
+        file = path.realpath(path.join(directory, path.basename(item)))
+        if not path.isfile(file):
+            raise TrackError(f"Unable to find file {item}")
+        return Mp3File(log, file, requester=requester)
+    else:
+        search = Mp3FileSearch(log, item, requester)
+
+    with search_latency.time(type(search).__name__):
+        await search.get()
+    if not search.tracks:
+        raise SearchError(f"No results found for {item}")
+    return search.tracks[0]
+
+
+youtube_search_flight = SingleFlight("youtube search")
+clyp_search_flight = SingleFlight("clyp search")
+
+search_flights = [
+    youtube_search_flight,
+    clyp_search_flight,
+    stream_flight
+]
+
+registry.counter(
+    "player_singleflight_total", "Calls made, coalesced into an in-flight call or rejected", ["flight", "result"],
+    function=lambda: {(flight.name, result): count for flight in search_flights for result, count in flight.stats.items() if result != "in_flight"})
+
 search_types = [
     (Mp3FileSearch, "mp3"),
     (YoutubeSearch, "youtube"),
@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/silence.py
+Leading and trailing silence analysis
+
+Finds how much silence each track in a library starts and ends with,
+decoding only the ends of each file with ffmpeg across worker threads.
+Results are kept next to the library's catalog, which stores the
+offsets with each track so playback can skip the silence without any
+analysis of its own. Only new and changed files are analyzed.
+
+Run from the repository root (ffmpeg must be installed):
+    python -m cogs.player.silence lib/mp3 --workers 4
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import time
+
+from glob import glob
+
+import numpy
+
+from .catalog import rebuild_catalog, silence_file
+from .config import *
+
+__all__ = [
+    "analyze",
+    "analyze_directory"
+]
+
+SAMPLE_RATE = 8000  # plenty to find where audio starts
+WINDOW = 0.01  # seconds of audio tested for silence at a time
+
+
+def _decode(file, before_options):
+    """Returns the mono samples of part of a file"""
+    process = subprocess.run(["ffmpeg", "-v", "error", *before_options, "-i", file,
+                              "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    return numpy.frombuffer(process.stdout, numpy.int16)
+
+
+def _silent_seconds(samples):
+    """Returns the seconds of silence the samples start with, less padding"""
+    window = int(SAMPLE_RATE * WINDOW)
+    windows = samples[:len(samples) // window * window].reshape(-1, window)
+    if not len(windows):
+        return 0
+
+    threshold = 32768 * 10 ** (SILENCE_THRESHOLD / 20)
+    loud = numpy.abs(windows.astype(numpy.int32)).max(axis=1) >= threshold
+    first = numpy.argmax(loud) if loud.any() else len(loud)
+    return max(float(first) * WINDOW - SILENCE_PADDING, 0)
+
+
+def analyze(file):
+    """Returns the seconds of silence at the start and end of a file"""
+    seconds = str(SILENCE_SCAN_SECONDS)
+    head = _decode(file, ["-t", seconds])
+    tail = _decode(file, ["-sseof", f"-{seconds}"])
+    return round(_silent_seconds(head), 3), round(_silent_seconds(tail[::-1]), 3)
+
+
+def _load(file):
+    try:
+        with open(file) as analysis:
+            return json.load(analysis)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _save(file, results):
+    temporary = f"{file}.{os.getpid()}.tmp"
+    with open(temporary, "w") as analysis:
+        json.dump(results, analysis)
+    os.replace(temporary, file)
+
+
+def analyze_directory(directory, *, workers=None, log=print):
+    """Analyzes the new and changed MP3 files in a directory, then rebuilds its catalog
+
+    Returns the number of files analyzed.
+    """
+    directory = os.path.realpath(directory)
+    file = silence_file(directory)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+
+    results = _load(file)
+    pending = dict()
+    for path in sorted(glob(directory + "/*.mp3")):
+        stat = os.stat(path)
+        identity = [stat.st_mtime_ns, stat.st_size]
+        if results.get(path, [None, None])[:2] != identity:
+            pending[path] = identity
+    # forget files which have been removed
+    results = {path: analysis for path, analysis in results.items()
+               if os.path.isfile(path)}
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(workers or SILENCE_WORKERS) as executor:
+        futures = {executor.submit(analyze, path): path for path in pending}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    results[path] = pending[path] + list(future.result())
+                except (OSError, subprocess.CalledProcessError) as e:
+                    log(f"Failed to analyze {path.encode('utf-8', 'ignore')}: {type(e).__name__}")
+        finally:
+            # keep what was analyzed if interrupted
+            for future in futures:
+                future.cancel()
+            _save(file, results)
+
+    log(f"Analyzed {len(pending)} of {len(results)} files in {time.perf_counter() - started:.1f}s")
+    rebuild_catalog(directory)
+    return len(pending)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory", nargs="?", default=DEFAULT_PLAYLIST_DIRECTORY)
+    parser.add_argument("--workers", type=int, default=SILENCE_WORKERS,
+                        help="files analyzed at once, defaults to the number of cores")
+    args = parser.parse_args()
+
+    analyze_directory(args.directory, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
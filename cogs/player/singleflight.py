@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/singleflight.py
+Request coalescing for search and track resolution
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import asyncio
+
+from .config import *
+
+__all__ = [
+    "SingleFlight",
+
+    "SingleFlightError"
+]
+
+
+class SingleFlightError(Exception):
+    """"""
+    pass
+
+
+class SingleFlight:
+    """Coalesces concurrent calls sharing a key into one in-flight call"""
+
+    def __init__(self, name, *, max_waiters=None):
+
+        self.name = name
+        self.max_waiters = max_waiters or SINGLEFLIGHT_MAX_WAITERS
+
+        self.flights = dict()
+
+        self.calls = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    def _land(self, key, future):
+        """Removes a finished call so the next caller starts a new one"""
+        flight = self.flights.get(key, None)
+        if flight is not None and flight[0] is future:
+            del self.flights[key]
+
+    async def do(self, key, function, *args):
+        """Returns the result of ``function(*args)``
+
+        If a call with the same key is already in flight its result is
+        shared instead of starting a new call.
+        """
+        flight = self.flights.get(key, None)
+
+        if flight is None:
+            future = asyncio.ensure_future(function(*args))
+            future.add_done_callback(lambda f: self._land(key, f))
+            flight = self.flights[key] = [future, 0]
+            self.calls += 1
+        elif flight[1] >= self.max_waiters:
+            self.rejected += 1
+            raise SingleFlightError(
+                f"Too many identical {self.name} requests in progress")
+        else:
+            self.coalesced += 1
+
+        flight[1] += 1
+        try:
+            # shielded so one cancelled waiter doesn't cancel the others
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+
+    @property
+    def stats(self):
+        """Returns a dict of call counters"""
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "in_flight": len(self.flights)
+        }
@@ -0,0 +1,344 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/source.py
+Audio sources used by player sessions
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import audioop
+import collections
+import threading
+import time
+
+import discord
+import numpy
+
+from ..utils.metrics import registry
+from .config import *
+from .encoder import configure_encoder, encoder_time
+
+__all__ = [
+    "CrossfadeMixer",
+    "FrameStats",
+    "SessionSource",
+    "WorkerSessionSource"
+]
+
+FRAME_LENGTH = 0.02  # seconds of audio per frame
+FRAME_SAMPLES = discord.opus.Encoder.SAMPLES_PER_FRAME
+
+# position of each interleaved stereo sample within its frame, from 0 to 1
+_RAMP = numpy.repeat(numpy.arange(FRAME_SAMPLES, dtype=numpy.float32) / FRAME_SAMPLES,
+                     discord.opus.Encoder.CHANNELS)
+
+# fade out and fade in gains at positions through a crossfade
+CROSSFADE_CURVES = {
+    "linear": lambda position: (1 - position, position),
+    "equal_power": lambda position: (numpy.cos(position * numpy.pi / 2), numpy.sin(position * numpy.pi / 2))
+}
+
+frame_lateness = registry.histogram(
+    "player_frame_lateness_seconds", "Lateness of audio frame reads against the 20ms schedule",
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25))
+frame_stage_time = registry.histogram(
+    "player_frame_stage_seconds", "Time spent on each stage of producing an audio frame", ["stage"],
+    buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05))
+frame_underruns = registry.counter(
+    "player_frame_underruns_total", "Audio frames produced after their 20ms slot")
+
+
+class FrameStats:
+    """Rolling per-frame timings for a session
+
+    Records are written by the audio thread and read by commands,
+    so access is guarded by a lock.
+    """
+
+    STAGES = ("lateness", "pipe", "volume", "encode", "total")
+
+    def __init__(self, *, window=None):
+
+        self.window = window or FRAME_STATS_WINDOW
+        self.frames = collections.deque(maxlen=self.window)
+        self.count = 0
+        self.underruns = 0
+
+        self._lock = threading.Lock()
+
+    def record(self, lateness, pipe, volume, encode):
+        """Records the timings of one frame"""
+        total = pipe + volume + encode
+        underrun = lateness + total > FRAME_LENGTH
+
+        with self._lock:
+            self.frames.append((lateness, pipe, volume, encode, total))
+            self.count += 1
+            self.underruns += underrun
+
+        frame_lateness.observe(lateness)
+        frame_stage_time.observe(pipe, "pipe")
+        frame_stage_time.observe(volume, "volume")
+        frame_stage_time.observe(encode, "encode")
+        if underrun:
+            frame_underruns.inc()
+
+    def percentiles(self, percentiles=(50, 95, 99, 100)):
+        """Returns a dict of stage to a list of timings at each percentile"""
+        with self._lock:
+            frames = list(self.frames)
+        if not frames:
+            return dict()
+
+        result = dict()
+        for index, stage in enumerate(self.STAGES):
+            timings = sorted(frame[index] for frame in frames)
+            result[stage] = [timings[min(len(timings) - 1, len(timings) * p // 100)]
+                             for p in percentiles]
+        return result
+
+    @property
+    def summary(self):
+        """Returns a table of stage percentiles in milliseconds"""
+        lines = [f"{'stage':<10}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+        for stage, timings in self.percentiles().items():
+            lines.append(f"{stage:<10}" +
+                         "".join(f"{timing * 1000:>9.3f}" for timing in timings))
+        lines.append(
+            f"frames: {self.count} underruns: {self.underruns} window: {len(self.frames)}")
+        return "\n".join(lines)
+
+
+class FrameClock:
+    """Measures how late each frame is read against the 20ms schedule"""
+
+    RESYNC_AFTER = 1  # seconds late before assuming the player was paused
+
+    def __init__(self):
+        self._expected = None
+
+    def reset(self):
+        """Starts the schedule again from the next frame, as after playback is moved"""
+        self._expected = None
+
+    def tick(self, now):
+        """Returns the lateness of a frame read at ``now``"""
+        if self._expected is None or now - self._expected > self.RESYNC_AFTER:
+            self._expected = now
+        lateness = max(now - self._expected, 0)
+        self._expected += FRAME_LENGTH
+        return lateness
+
+
+class SessionSource(discord.PCMVolumeTransformer):
+    """Volume controlled audio source which times each frame
+
+    If an encoder is given frames are Opus encoded here rather than by
+    the voice client so that encoding can be timed too.
+    """
+
+    def __init__(self, original, volume=1.0, *, encoder=None, stats=None):
+        super().__init__(original, volume)
+
+        self.encoder = encoder
+        self.stats = stats or FrameStats()
+        self.clock = FrameClock()
+
+        self.complexity = "default"
+        self._encoder_settings = None
+
+    def is_opus(self):
+        return self.encoder is not None
+
+    def configure(self, bitrate, complexity):
+        """Sets the encoder's bitrate and complexity before the next frame is encoded"""
+        self._encoder_settings = (bitrate, complexity)
+
+    @property
+    def position(self):
+        """Returns the seconds played of the current track"""
+        return self.original.position
+
+    def read(self):
+        started = time.perf_counter()
+        lateness = self.clock.tick(started)
+
+        data = self.original.read()
+        if not data:
+            return data
+        piped = time.perf_counter()
+
+        data = audioop.mul(data, 2, min(self.volume, 2.0))
+        scaled = time.perf_counter()
+
+        if self.encoder is not None:
+            if self._encoder_settings is not None:
+                settings, self._encoder_settings = self._encoder_settings, None
+                configure_encoder(self.encoder, *settings)
+                self.complexity = str(settings[1])
+            data = self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+        encoded = time.perf_counter()
+
+        self.stats.record(lateness, piped - started,
+                          scaled - piped, encoded - scaled)
+        if self.encoder is not None:
+            encoder_time.inc(self.complexity, amount=encoded - scaled)
+        return data
+
+
+class WorkerSessionSource(discord.AudioSource):
+    """Audio source for frames already scaled and encoded by an audio worker
+
+    Volume changes are passed on to the worker. Only the wait for each
+    frame is timed here, recorded as the pipe stage.
+    """
+
+    def __init__(self, original, volume=1.0, *, stats=None):
+
+        self.original = original
+        self._volume = volume
+        self.stats = stats or FrameStats()
+        self.clock = FrameClock()
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+        self.original.set_volume(self._volume)
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def configure(self, bitrate, complexity):
+        """Sets the bitrate and complexity of the audio worker's encoder"""
+        self.original.configure(bitrate, complexity)
+
+    @property
+    def position(self):
+        """Returns the seconds played of the track"""
+        return self.original.position
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def read(self):
+        started = time.perf_counter()
+        lateness = self.clock.tick(started)
+
+        data = self.original.read()
+        if data:
+            self.stats.record(
+                lateness, time.perf_counter() - started, 0, 0)
+        return data
+
+
+class CrossfadeMixer(discord.AudioSource):
+    """PCM source which plays tracks back to back, crossfading between them
+
+    The last ``seconds`` of the current track are held back, read ahead
+    a frame at a time, so when it ends they can be mixed with the start
+    of the next track. The next track is offered with :meth:`offer` and
+    only taken if its check still passes when the current track ends,
+    otherwise the held back frames are played out and the mixer ends.
+    """
+
+    def __init__(self, original, *, seconds=None, curve=None, position=0):
+
+        self.current = original
+        self.played = round(position / FRAME_LENGTH)  # frames played of the current track
+        self.frames = round(
+            (CROSSFADE_SECONDS if seconds is None else seconds) / FRAME_LENGTH)
+        self.curve = CROSSFADE_CURVES[curve or CROSSFADE_CURVE]
+        self.ended = False
+
+        self.tail = collections.deque()  # held back frames of the current track
+        self.outgoing = collections.deque()  # frames of the previous track being faded out
+        self.fade_position = 0
+        self.fade_length = 0
+
+        self._next = None
+        self._lock = threading.Lock()
+
+    @property
+    def fading(self):
+        return bool(self.outgoing)
+
+    @property
+    def position(self):
+        return self.played * FRAME_LENGTH
+
+    def offer(self, source, *, check, started):
+        """Offers the source of the next track
+
+        ``check`` is called when the current track ends and ``started``
+        once the source is taken, both from the audio thread.
+        """
+        with self._lock:
+            self._next = (source, check, started)
+
+    def withdraw(self, source):
+        """Withdraws an offered source, returning False if it has already been taken"""
+        with self._lock:
+            if self._next is not None and self._next[0] is source:
+                self._next = None
+            return source is not self.current
+
+    def _take_next(self):
+        with self._lock:
+            offer, self._next = self._next, None
+            if offer is None or not offer[1]():
+                return False
+            previous, self.current = self.current, offer[0]
+
+        previous.cleanup()
+        self.ended = False
+        self.played = 0
+        self.outgoing, self.tail = self.tail, collections.deque()
+        self.fade_position, self.fade_length = 0, len(self.outgoing)
+        offer[2]()
+        return True
+
+    def _fill(self):
+        """Reads the current track into the held back frames"""
+        for read in range(2 if len(self.tail) < self.frames else 1):
+            data = self.current.read()
+            if not data:
+                self.ended = True
+                return
+            self.tail.append(data)
+
+    def _mix(self):
+        outgoing = numpy.frombuffer(self.outgoing.popleft(), numpy.int16)
+        incoming = b"" if self.ended else self.current.read()
+        self.ended = not incoming
+
+        fade_out, fade_in = self.curve(
+            (self.fade_position + _RAMP) / self.fade_length)
+        self.fade_position += 1
+
+        mixed = outgoing * fade_out
+        if incoming:
+            self.played += 1
+            mixed += numpy.frombuffer(incoming, numpy.int16) * fade_in
+        return numpy.clip(mixed, -32768, 32767).astype(numpy.int16).tobytes()
+
+    def read(self):
+        if self.outgoing:
+            return self._mix()
+        if not self.ended:
+            self._fill()
+        if self.ended and self._take_next():
+            return self.read()
+        if not self.tail:
+            return b""
+        self.played += 1
+        return self.tail.popleft()
+
+    def cleanup(self):
+        with self._lock:
+            self._next = None
+        self.current.cleanup()
@@ -7,19 +7,33 @@ Audio track classes
 Copyright (c) 2017 Joshua Butt
 """
 
+import functools
+import io
+import os
+import time
+
 import discord
 import pafy
 
+from mutagen import MutagenError
+from mutagen.id3 import ID3
 from mutagen.mp3 import MP3
 
+from ..utils.metrics import registry
 from .config import *
+from .read_ahead import ffmpeg_source
+from .singleflight import SingleFlight
 
 __all__ = [
     'Mp3File',
     'YoutubeVideo',
     'ClypTrack',
 
-    'TrackError'
+    'TrackError',
+
+    'RenderedEmbed',
+    'image',
+    'stream_flight'
 ]
 
 
@@ -28,46 +42,163 @@ class TrackError(Exception):
     pass
 
 
+stream_flight = SingleFlight("stream resolution")
+
+mp3file_load_time = registry.histogram(
+    "player_mp3file_load_seconds", "Time taken to construct an Mp3File")
+
+
+@functools.lru_cache(maxsize=None)
+def image(file):
+    """Returns the contents of a bundled image, read from disk once"""
+    with open(file, 'rb') as image_file:
+        return image_file.read()
+
+
+def art_not_found():
+    """Returns the placeholder cover art"""
+    return image(ART_NOT_FOUND_FILE)
+
+
+@functools.lru_cache(maxsize=COVER_CACHE_SIZE)
+def _cover(file, log):
+    """Returns the album artwork from a file's ID3 tag"""
+    try:
+        return ID3(file)[u'APIC:'].data
+    except (MutagenError, KeyError):
+        log.warning(
+            f"Failed to find cover for {file.encode('utf-8', 'ignore')}")
+        return art_not_found()
+
+
+class RenderedEmbed:
+    """An embed rendered once along with how to get its attachment
+
+    The embed is shared by every send so must not be modified. A new
+    :class:`discord.File` is made for each send, as files can only be
+    sent once.
+    """
+
+    __slots__ = ("embed", "filename", "attachment")
+
+    def __init__(self, embed, filename=None, attachment=None):
+
+        self.embed = embed
+        self.filename = filename
+        self.attachment = attachment
+
+    @property
+    def payload(self):
+        """Returns keyword arguments for :meth:`discord.abc.Messageable.send`"""
+        if self.attachment is None:
+            return {"embed": self.embed}
+        return {
+            "embed": self.embed,
+            "file": discord.File(io.BytesIO(self.attachment()), self.filename)
+        }
+
+
 class Track:
-    """Base class for various audio track types"""
+    """Base class for various audio track types
+
+    Tracks can sit in queues by the thousand, so subclasses declare
+    ``__slots__`` and keep only what embeds and playback use. Embeds are
+    rendered on first use and again only if the requester changes.
+    """
+
+    __slots__ = ("_rendered",)
+
+    def _cached(self, name, render):
+        """Returns a memoized rendering"""
+        requester = getattr(self, "requester", None)
+        try:
+            rendered = self._rendered
+        except AttributeError:
+            rendered = self._rendered = dict()
+
+        cached = rendered.get(name, None)
+        if cached is None or cached[0] is not requester:
+            cached = rendered[name] = (requester, render())
+        return cached[1]
+
+    async def resolve(self, loop):
+        """Resolves anything required by :attr:`player` ahead of playback"""
+        pass
+
+    @property
+    def ffmpeg_input(self):
+        """Returns the keyword arguments for :class:`discord.FFmpegPCMAudio`"""
+        return self.ffmpeg_input_at(0)
+
+    def ffmpeg_input_at(self, position):
+        """Returns the keyword arguments to play from a number of seconds into the track"""
+        raise NotImplementedError
 
     @property
     def player(self):
         """Returns an instance of :class:`discord.FFmpegPCMAudio`"""
-        raise NotImplementedError
+        return ffmpeg_source(self.ffmpeg_input)
 
     @property
     def request_embed(self):
-        """Returns an instance of :class:`discord.Embed`"""
-        raise NotImplementedError
+        """Returns the payload sent when the track is requested"""
+        return self._cached("request", self._render_request_embed).payload
 
     @property
     def playing_embed(self):
-        """Returns an instance of :class:`discord.Embed`"""
-        raise NotImplementedError
+        """Returns the payload sent when the track starts playing"""
+        return self._cached("playing", self._render_playing_embed).payload
 
     @property
     def queue(self):
-        """Returns a string containg information to be displayed in the upcoming queue"""
+        """Returns a dict containg information to be displayed in the upcoming queue"""
+        return self._cached("queue", self._render_queue)
+
+    def _render_request_embed(self):
+        """Returns a :class:`RenderedEmbed`"""
+        raise NotImplementedError
+
+    def _render_playing_embed(self):
+        """Returns a :class:`RenderedEmbed`"""
+        raise NotImplementedError
+
+    def _render_queue(self):
         raise NotImplementedError
 
 # - Local MP3 File
 
 
 class Mp3File(Track):
-    """Class containing metadata for MP3 file"""
+    """Class containing metadata for MP3 file
+
+    The cover is read from the file when an embed needs it rather than
+    being kept with the track.
+    """
+
+    __slots__ = ("log", "requester", "file",
+                 "title", "artist", "album", "date", "start", "end")
 
-    def __init__(self, log, file, *, requester=None):
+    def __init__(self, log, file, *, requester=None, tags=None):
+        started = time.perf_counter()
 
         self.log = log
         self.requester = requester
 
         self.file = file
-        self.filename = self.file.encode("utf-8", 'ignore')
         self.title = None
         self.artist = None
         self.date = None
         self.album = None
+        # offsets to play between, skipping silence, 0 to play from the start or to the end
+        self.start = 0
+        self.end = 0
+
+        if tags is not None:
+            for var in ("title", "artist", "album", "date"):
+                setattr(self, var, tags[var])
+            self.start = tags.get("start", 0)
+            self.end = tags.get("end", 0)
+            return
 
         try:
             mp3_file = MP3(self.file)
@@ -83,7 +214,7 @@ class Mp3File(Track):
         # Strip MP3 metadata
         for var, tag in tags:
             try:
-                setattr(self, var, mp3_file.tags[tag][0])
+                setattr(self, var, str(mp3_file.tags[tag][0]))
             except KeyError:
                 self.log.warning(
                     f"Failed to find {var} for {self.filename} perhaps you have no ID3 tags populated")
@@ -96,94 +227,108 @@ class Mp3File(Track):
                 self.log.error(f"Failed to load track {self.filename}")
                 raise TrackError("Possibly corrupt MP3 tag")
 
-        # Find album artwork
-        try:
-            self.cover = mp3_file[u'APIC:'].data
-        except KeyError as e:
-            self.log.warning(f"Failed to find cover for {self.filename}")
-            self.cover = open(ART_NOT_FOUND_FILE, 'rb')
+        mp3file_load_time.observe(time.perf_counter() - started)
+
+    @classmethod
+    def from_catalog(cls, log, catalog, index, *, requester=None):
+        """Returns the track for a catalog entry without reading the file"""
+        file = catalog.path(index)
+        if not os.path.isfile(file):  # removed since the catalog was built
+            raise TrackError("Unable to find file")
+        return cls(log, file, requester=requester, tags=catalog.tags(index))
 
     @property
-    def player(self):
-        return discord.FFmpegPCMAudio(self.file)
+    def filename(self):
+        return self.file.encode("utf-8", 'ignore')
 
     @property
-    def request_embed(self):
+    def cover(self):
+        """Returns the album artwork, recently used covers are kept in memory"""
+        return _cover(self.file, self.log)
+
+    def ffmpeg_input_at(self, position):
+        start = self.start + position
+        ffmpeg_input = {"source": self.file}
+        if start:
+            ffmpeg_input["before_options"] = f"-ss {start:.3f}"
+        if self.end:
+            ffmpeg_input["options"] = f"-t {max(self.end - start, 0):.3f}"
+        return ffmpeg_input
+
+    def _render_request_embed(self):
         embed = discord.Embed(title="Local track request...",
                               description=f"adding **{self.title}** by **{self.artist}** to the queue...", colour=0x009688)
         embed.set_author(
             name=f"Local track - requested by {self.requester.name}", icon_url=self.requester.avatar_url)
         embed.set_thumbnail(url="attachment://cover.jpg")
-        return {
-            "embed": embed,
-            "file": discord.File(self.cover, "cover.jpg")
-        }
+        return RenderedEmbed(embed, "cover.jpg", functools.partial(_cover, self.file, self.log))
 
-    @property
-    def playing_embed(self):
+    def _render_playing_embed(self):
         embed = discord.Embed(
             title=self.title, description=f"{self.album} - ({self.date})", colour=0x009688)
         embed.set_author(name=self.artist)
         embed.set_thumbnail(url="attachment://cover.jpg")
-        return {
-            "embed": embed,
-            "file": discord.File(self.cover, "cover.jpg")
-        }
+        return RenderedEmbed(embed, "cover.jpg", functools.partial(_cover, self.file, self.log))
 
-    @property
-    def queue(self):
+    def _render_queue(self):
         return {
             "name": self.title,
             "value": f"{self.artist}: {self.album} - ({self.date})"
         }
+
 # - Youtube Video
 
 
 class YoutubeVideo(Track):
     """Class containing metadata for a YouTube video"""
 
-    def __init__(self, log, video, requester):
+    __slots__ = ("title", "creator", "url", "thumbnail",
+                 "requester", "stream_url")
 
-        self.video = video
+    def __init__(self, log, video, requester):
 
-        self.title = self.video["snippet"]["title"]
-        self.creator = self.video["snippet"]["channelTitle"]
-        self.url = f"https://youtu.be/{self.video['id']}"
-        self.thumbnail = self.video["snippet"]["thumbnails"]["default"]["url"]
+        self.title = video["snippet"]["title"]
+        self.creator = video["snippet"]["channelTitle"]
+        self.url = f"https://youtu.be/{video['id']}"
+        self.thumbnail = video["snippet"]["thumbnails"]["default"]["url"]
 
         self.requester = requester
-
-    @property
-    def player(self):
-        player = pafy.new(self.url)
-        return discord.FFmpegPCMAudio(player.getbestaudio().url, options="-bufsize 7680k")
-
-    @property
-    def request_embed(self):
+        self.stream_url = None
+
+    @staticmethod
+    def _get_stream_url(url):
+        """Returns the best audio stream URL for a video URL"""
+        return pafy.new(url).getbestaudio().url
+
+    async def resolve(self, loop):
+        self.stream_url = await stream_flight.do(
+            self.url, loop.run_in_executor, None, self._get_stream_url, self.url)
+
+    def ffmpeg_input_at(self, position):
+        stream_url = self.stream_url or self._get_stream_url(self.url)
+        ffmpeg_input = {"source": stream_url,
+                        "options": "-bufsize 7680k", "read_ahead": True}
+        if position:
+            ffmpeg_input["before_options"] = f"-ss {position:.3f}"
+        return ffmpeg_input
+
+    def _render_request_embed(self):
         embed = discord.Embed(title="YouTube track request...",
                               description=f"adding **{self.title}** by **{self.creator}** to the queue...", colour=0xf44336)
         embed.set_author(
             name=f"Youtube Video - requested by {self.requester.name}", url=self.url, icon_url="attachment://youtube.png")
         embed.set_thumbnail(url=self.thumbnail)
-        return {
-            "embed": embed,
-            "file": discord.File(open(YOUTUBE_LOGO_FILE, 'rb'), "youtube.png")
-        }
+        return RenderedEmbed(embed, "youtube.png", functools.partial(image, YOUTUBE_LOGO_FILE))
 
-    @property
-    def playing_embed(self):
+    def _render_playing_embed(self):
         embed = discord.Embed(
             title=self.title, description=self.creator, colour=0xf44336)
         embed.set_author(
             name=f"Youtube Video - requested by {self.requester.name}", url=self.url, icon_url="attachment://youtube.png")
         embed.set_thumbnail(url=self.thumbnail)
-        return {
-            "embed": embed,
-            "file": discord.File(open(YOUTUBE_LOGO_FILE, 'rb'), "youtube.png")
-        }
+        return RenderedEmbed(embed, "youtube.png", functools.partial(image, YOUTUBE_LOGO_FILE))
 
-    @property
-    def queue(self):
+    def _render_queue(self):
         return {
             "name": self.title,
             "value": f"{self.creator} - requested by - {self.requester.name}"
@@ -195,48 +340,43 @@ class YoutubeVideo(Track):
 class ClypTrack(Track):
     """Class containing metadata for a Clyp Track"""
 
-    def __init__(self, log, track, requester):
+    __slots__ = ("title", "url", "thumbnail", "mp3_url", "requester")
 
-        self.track = track
+    def __init__(self, log, track, requester):
 
-        self.title = self.track["Title"]
-        self.url = f"https://clyp.it/{self.track['AudioFileId']}"
+        self.title = track["Title"]
+        self.url = f"https://clyp.it/{track['AudioFileId']}"
+        self.mp3_url = track["Mp3Url"]
 
-        self.thumbnail = self.track.get("ArtworkPictureUrl", None)
+        self.thumbnail = track.get("ArtworkPictureUrl", None)
 
         self.requester = requester
 
-    @property
-    def player(self):
-        return discord.FFmpegPCMAudio(self.track["Mp3Url"], options="-bufsize 7680k")
+    def ffmpeg_input_at(self, position):
+        ffmpeg_input = {"source": self.mp3_url,
+                        "options": "-bufsize 7680k", "read_ahead": True}
+        if position:
+            ffmpeg_input["before_options"] = f"-ss {position:.3f}"
+        return ffmpeg_input
 
-    @property
-    def request_embed(self):
+    def _render_request_embed(self):
         embed = discord.Embed(title="Clyp track request...",
                               description=f"adding **{self.title}** to the queue...", colour=0x009688)
         embed.set_author(
             name=f"Clyp - requested by {self.requester.name}", url=self.url, icon_url="attachment://clyp.png")
         if self.thumbnail is not None:
             embed.set_thumbnail(url=self.thumbnail)
-        return {
-            "embed": embed,
-            "file": discord.File(open(CLYP_LOGO_FILE, 'rb'), "clyp.png")
-        }
+        return RenderedEmbed(embed, "clyp.png", functools.partial(image, CLYP_LOGO_FILE))
 
-    @property
-    def playing_embed(self):
+    def _render_playing_embed(self):
         embed = discord.Embed(title=self.title, colour=0x009688)
         embed.set_author(
             name=f"Clyp Track - requested by {self.requester.name}", url=self.url, icon_url="attachment://clyp.png")
         if self.thumbnail is not None:
             embed.set_thumbnail(url=self.thumbnail)
-        return {
-            "embed": embed,
-            "file": discord.File(open(CLYP_LOGO_FILE, 'rb'), "clyp.png")
-        }
+        return RenderedEmbed(embed, "clyp.png", functools.partial(image, CLYP_LOGO_FILE))
 
-    @property
-    def queue(self):
+    def _render_queue(self):
         return {
             "name": self.title,
             "value": f"requested by - {self.requester.name}"
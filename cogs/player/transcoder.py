@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/player/transcoder.py
+ffmpeg process scheduling and monitoring
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import signal
+import time
+
+import discord
+
+from ..utils.metrics import registry
+from .config import *
+from .read_ahead import ffmpeg_source
+
+__all__ = [
+    "TranscoderScheduler",
+    "TranscodedSource",
+
+    "PLAYING",
+    "PREFETCH"
+]
+
+# Transcoder priorities, lower is more urgent
+PLAYING = 0
+PREFETCH = 1
+
+transcoder_wait_time = registry.histogram(
+    "player_transcoder_wait_seconds", "Time spent waiting for a transcoder slot", ["priority"])
+transcoder_spawn_time = registry.histogram(
+    "player_ffmpeg_spawn_seconds", "Time taken to spawn an ffmpeg process")
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class TranscodedSource(discord.AudioSource):
+    """Wraps an ffmpeg audio source which holds a slot in a :class:`TranscoderScheduler`
+
+    The source is either a :class:`discord.FFmpegPCMAudio` or a
+    :class:`WorkerSource` whose ffmpeg process runs under an audio worker.
+    """
+
+    def __init__(self, scheduler, original, guild):
+
+        self.scheduler = scheduler
+        self.original = original
+        self.guild = guild
+
+        process = getattr(original, "_process", None)
+        self.pid = process.pid if process else getattr(original, "pid", None)
+        self.started = time.time()
+
+        self.cpu_time = 0
+        self.cpu_percent = 0
+        self.rss = 0
+        self.strikes = 0
+        self.reniced = False
+
+        self._sampled = time.monotonic()
+        self._released = False
+
+    def read(self):
+        return self.original.read()
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def set_volume(self, volume):
+        """Sets the volume applied by an audio worker"""
+        self.original.volume = volume
+
+    def configure(self, bitrate, complexity):
+        """Sets the settings of an audio worker's encoder"""
+        self.original.configure(bitrate, complexity)
+
+    @property
+    def position(self):
+        """Returns the seconds of the track read from an audio worker"""
+        return self.original.position
+
+    def cleanup(self):
+        self.original.cleanup()
+        if not self._released:
+            self._released = True
+            # cleanup is called from the audio thread
+            self.scheduler.loop.call_soon_threadsafe(
+                self.scheduler._finished, self)
+
+    def sample(self):
+        """Updates cpu and memory usage from /proc"""
+        try:
+            with open(f"/proc/{self.pid}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{self.pid}/statm") as statm:
+                resident = int(statm.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return
+
+        now = time.monotonic()
+        cpu_time = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+        self.cpu_percent = 100 * (cpu_time - self.cpu_time) / \
+            max(now - self._sampled, 1e-6)
+        self.cpu_time = cpu_time
+        self.rss = resident * _PAGE_SIZE
+        self._sampled = now
+
+    def renice(self, niceness):
+        """Sets the niceness of the ffmpeg process"""
+        os.setpriority(os.PRIO_PROCESS, self.pid, niceness)
+        self.reniced = True
+
+    def kill(self):
+        """Kills the ffmpeg process, ending the track"""
+        os.kill(self.pid, signal.SIGKILL)
+
+
+class TranscoderScheduler:
+    """Limits the number of concurrent ffmpeg processes across all sessions
+
+    Waiting sessions are granted slots in priority order, so currently
+    playing guilds are served before prefetches. If an
+    :class:`AudioWorkerPool` is given ffmpeg is run by its workers.
+    """
+
+    def __init__(self, loop, log, *, limit=None, audio_workers=None):
+
+        self.loop = loop
+        self.log = log
+        self.limit = limit or TRANSCODER_LIMIT
+        self.audio_workers = audio_workers
+
+        self.active = 0
+        self.waiters = list()
+        self.sources = dict()
+        self._counter = itertools.count()
+
+        self.monitor = self.loop.create_task(self._monitor_task())
+
+        registry.gauge("player_transcoders", "Running and waiting ffmpeg processes", ["state"],
+                       function=lambda: {("running",): self.active, ("waiting",): len(self.waiters)})
+
+    async def _acquire(self, priority):
+        """Waits for a free transcoder slot"""
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+
+        future = self.loop.create_future()
+        heapq.heappush(self.waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # pass the slot on if it was granted as we were cancelled
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        """Hands a slot to the most urgent waiter or frees it"""
+        while self.waiters:
+            priority, count, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def _finished(self, source):
+        self.sources.pop(id(source), None)
+        self._release()
+
+    async def open(self, track, guild, *, priority=PLAYING, volume=1.0, position=0):
+        """Returns a :class:`TranscodedSource` for a track once a slot is free
+
+        ``volume`` is only used by audio workers, which scale the audio
+        before it reaches the session. ``position`` is the number of
+        seconds into the track to start from.
+        """
+        with transcoder_wait_time.time(priority):
+            await self._acquire(priority)
+        try:
+            with transcoder_spawn_time.time():
+                if self.audio_workers is not None:
+                    original = await self.audio_workers.open(track, volume=volume, position=position)
+                else:
+                    original = ffmpeg_source(
+                        track.ffmpeg_input_at(position))
+                source = TranscodedSource(self, original, guild)
+        except BaseException:  # including cancellation while a worker starts ffmpeg
+            self._release()
+            raise
+
+        self.sources[id(source)] = source
+        return source
+
+    @property
+    def can_prefetch(self):
+        """Whether there are enough free slots to open a track ahead of time"""
+        return not self.waiters and self.limit - self.active > TRANSCODER_PREFETCH_RESERVE
+
+    def get(self, pid):
+        """Returns the source running with a process ID"""
+        return next((source for source in self.sources.values() if source.pid == pid), None)
+
+    def stop(self):
+        """Stops monitoring processes"""
+        self.monitor.cancel()
+
+    async def _monitor_task(self):
+        """Samples processes, renicing and then killing runaways"""
+        while True:
+            await asyncio.sleep(TRANSCODER_MONITOR_INTERVAL)
+
+            for source in list(self.sources.values()):
+                if source.pid is None:
+                    continue
+                source.sample()
+
+                if source.cpu_percent > TRANSCODER_CPU_LIMIT:
+                    source.strikes += 1
+                else:
+                    source.strikes = 0
+
+                try:
+                    if source.rss > TRANSCODER_RSS_LIMIT or source.strikes >= TRANSCODER_STRIKES:
+                        self.log.warning(
+                            f"Killing runaway ffmpeg process {source.pid} for {source.guild}: {source.cpu_percent:.0f}% cpu, {source.rss // 1024}KiB")
+                        source.kill()
+                    elif source.strikes and not source.reniced:
+                        self.log.warning(
+                            f"Renicing ffmpeg process {source.pid} for {source.guild}: {source.cpu_percent:.0f}% cpu")
+                        source.renice(TRANSCODER_NICENESS)
+                except (OSError, AttributeError) as e:
+                    self.log.error(f"{type(e).__name__}: {e}")
@@ -0,0 +1,264 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/utils/metrics.py
+Metrics registry with a Prometheus endpoint
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import bisect
+import io
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+
+    "registry"
+]
+
+# Local endpoint for Prometheus metrics
+METRICS_HOST = os.environ.get("MP3BOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("MP3BOT_METRICS_PORT", 9310))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """Base class for metrics
+
+    Values are keyed by a tuple of label values. If ``function`` is given
+    it is called on collection and should return a dict of those values.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labels=(), *, function=None):
+
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+
+        self.values = dict()
+
+    def collect(self):
+        """Returns a dict of label values to values"""
+        if self.function is not None:
+            return self.function()
+        return dict(self.values)
+
+    def render(self):
+        """Returns the metric in Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type}"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing value"""
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value which can go up and down"""
+    type = "gauge"
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets"""
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labels=(), *, buckets=None):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        # observations can come from the audio threads
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.values.get(labels, None)
+            if series is None:
+                series = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Observes the time taken by the body of a with statement"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def collect(self):
+        with self._lock:
+            return {labels: [list(series[0]), series[1], series[2]] for labels, series in self.values.items()}
+
+    def quantile(self, q, *labels):
+        """Returns an estimate of a quantile from the bucket boundaries"""
+        series = self.collect().get(labels, None)
+        if series is None or series[2] == 0:
+            return None
+        rank = q * series[2]
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[0]):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type}"]
+        for labels, (counts, total, count) in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels, labels, [('le', bound)])} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+            lines.append(
+                f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """Collection of named metrics"""
+
+    def __init__(self):
+        self.metrics = dict()
+
+    def _get(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name, None)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif kwargs.get("function", None) is not None:
+            # callbacks are replaced so reloaded cogs report their new state
+            metric.function = kwargs["function"]
+        return metric
+
+    def counter(self, name, documentation, labels=(), *, function=None):
+        """Returns the :class:`Counter` with a name, creating it if needed"""
+        return self._get(Counter, name, documentation, labels, function=function)
+
+    def gauge(self, name, documentation, labels=(), *, function=None):
+        """Returns the :class:`Gauge` with a name, creating it if needed"""
+        return self._get(Gauge, name, documentation, labels, function=function)
+
+    def histogram(self, name, documentation, labels=(), *, buckets=None):
+        """Returns the :class:`Histogram` with a name, creating it if needed"""
+        return self._get(Histogram, name, documentation, labels, buckets=buckets)
+
+    def render(self):
+        """Returns all metrics in Prometheus text format"""
+        lines = list()
+        for name, metric in sorted(self.metrics.items()):
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # a broken callback shouldn't take down the endpoint
+                continue
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Returns a short human readable summary of all metrics"""
+        lines = list()
+        for name, metric in sorted(self.metrics.items()):
+            try:
+                values = metric.collect()
+            except Exception:
+                continue
+            for labels, value in sorted(values.items()):
+                label = f"{name}{_format_labels(metric.labels, labels)}"
+                if isinstance(metric, Histogram):
+                    counts, total, count = value
+                    lines.append(
+                        f"{label}: n={count} mean={total / max(count, 1):.4f} p50<={metric.quantile(0.5, *labels)} p99<={metric.quantile(0.99, *labels)}")
+                else:
+                    lines.append(f"{label}: {value}")
+        return "\n".join(lines)
+
+
+registry = Registry()
+
+
+class Metrics:
+    """Metrics endpoint and statistics"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.runner = None
+        self.bot.loop.create_task(self._start_server())
+
+    def __unload(self):
+        if self.runner is not None:
+            self.bot.loop.create_task(self.runner.cleanup())
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=registry.render(), content_type="text/plain")
+
+    async def _start_server(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, METRICS_HOST, METRICS_PORT).start()
+            self.bot.log.info(
+                f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}")
+        except OSError as e:
+            self.bot.log.error(
+                f"Failed to start metrics endpoint: {type(e).__name__}: {e}")
+
+    @commands.command(name="stats", hidden=True)
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """Displays a summary of the bot's metrics"""
+        summary = registry.summary() or "No metrics recorded yet..."
+
+        if len(summary) > 1900:
+            await ctx.send(file=discord.File(io.BytesIO(summary.encode("utf-8")), "stats.txt"))
+        else:
+            await ctx.send(f"```\n{summary}\n```")
+
+
+def setup(bot):
+    bot.add_cog(Metrics(bot))
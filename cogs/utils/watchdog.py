@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+
+"""
+mp3bot ~ cogs/utils/watchdog.py
+Event loop lag monitor
+
+Copyright (c) 2017 Joshua Butt
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+import discord
+from discord.ext import commands
+
+from .metrics import registry
+
+__all__ = [
+    "LagMonitor"
+]
+
+# Seconds between loop heartbeats
+LAG_INTERVAL = 0.1
+# Seconds the loop may be blocked before the blocking stack is captured
+LAG_THRESHOLD = 0.25
+
+# Frames from here are attributed blame before library frames
+BOT_DIRECTORY = os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__))))
+
+loop_lag = registry.histogram(
+    "bot_loop_lag_seconds", "Event loop lag measured by a periodic heartbeat",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+loop_stalls = registry.counter(
+    "bot_loop_stalls_total", "Times the event loop was blocked past the lag threshold", ["function"])
+
+
+class LagMonitor:
+    """Measures event loop lag and captures the stack of blocking callbacks
+
+    A heartbeat coroutine records how late each of its wake ups are, while
+    a watcher thread samples the loop thread's stack whenever the heartbeat
+    has been missing for longer than the threshold.
+    """
+
+    def __init__(self, loop, log, *, interval=LAG_INTERVAL, threshold=LAG_THRESHOLD):
+
+        self.loop = loop
+        self.log = log
+        self.interval = interval
+        self.threshold = threshold
+
+        self.max_lag = 0
+        self.stalls = list()
+
+        self._heartbeat = time.monotonic()
+        self._loop_thread = None
+        self._task = None
+        self._watcher = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Starts monitoring, must be called from the loop's thread"""
+        self._loop_thread = threading.get_ident()
+        self._task = self.loop.create_task(self._heartbeat_task())
+        self._watcher = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        """Stops monitoring"""
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _heartbeat_task(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+
+            lag = max(self._heartbeat - started - self.interval, 0)
+            self.max_lag = max(self.max_lag, lag)
+            loop_lag.observe(lag)
+
+    def _watch(self):
+        captured = None
+        while not self._stopped.wait(self.interval / 2):
+            heartbeat = self._heartbeat
+            if time.monotonic() - heartbeat < self.threshold:
+                continue
+            if captured == heartbeat:
+                # already reported this stall
+                continue
+            captured = heartbeat
+
+            frame = sys._current_frames().get(self._loop_thread, None)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            self._report(stack)
+
+    def _report(self, stack):
+        # blame the innermost frame in the bot's own code if there is one
+        culprit = next((frame for frame in reversed(stack)
+                        if frame.filename.startswith(BOT_DIRECTORY) and "site-packages" not in frame.filename), stack[-1])
+        function = f"{culprit.filename}:{culprit.lineno} {culprit.name}"
+
+        self.stalls.append((time.time(), function, stack))
+        del self.stalls[:-20]
+        loop_stalls.inc(function)
+
+        self.log.warning(f"Event loop blocked for over {self.threshold}s in {function}\n" +
+                         "".join(traceback.format_list(stack)))
+
+
+class Watchdog:
+    """Event loop monitoring"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.monitor = LagMonitor(self.bot.loop, self.bot.log)
+        self.monitor.start()
+
+    def __unload(self):
+        self.monitor.stop()
+
+    @commands.command(name="lag", hidden=True)
+    @commands.is_owner()
+    async def lag(self, ctx):
+        """Displays the worst loop lag and most recent stalls"""
+        embed = discord.Embed(
+            title="Event loop lag", description=f"Worst lag: {self.monitor.max_lag * 1000:.1f}ms", colour=0x009688)
+
+        for timestamp, function, stack in self.monitor.stalls[-5:]:
+            embed.add_field(
+                name=time.strftime("%H:%M:%S", time.localtime(timestamp)), value=function[-1024:], inline=False)
+
+        await ctx.send(embed=embed)
+
+
+def setup(bot):
+    bot.add_cog(Watchdog(bot))
@@ -7,6 +7,8 @@ Basic configuration for bot
 Copyright (c) 2017 Joshua Butt
 """
 
+from os import cpu_count, environ
+
 from secrets import TOKEN, OWNER_ID
 
 # Application Name
@@ -26,8 +28,25 @@ INITIAL_COGS = [
     # Key components
     "cogs.admin",
     "cogs.utils.help",
+    "cogs.utils.metrics",
+    "cogs.utils.watchdog",
 
     # Player cog
     "cogs.player"
 
-]
\ No newline at end of file
+]
+
+# Sharding
+# - SHARDED runs every shard in this process, SHARD_COUNT of None uses Discord's recommended count
+# - cluster.py sets the environment variables below to give each worker process a range of shards
+SHARDED = False
+SHARD_COUNT = int(environ["MP3BOT_SHARD_COUNT"]) if "MP3BOT_SHARD_COUNT" in environ else None
+SHARD_IDS = [int(shard_id) for shard_id in environ["MP3BOT_SHARD_IDS"].split(",")] if "MP3BOT_SHARD_IDS" in environ else None
+CLUSTER_WORKER = environ.get("MP3BOT_CLUSTER_WORKER", None)
+
+# Cluster launcher config
+CLUSTER_WORKERS = cpu_count() or 1
+CLUSTER_RESTART_DELAY = 5  # Seconds, doubled each time a worker crashes soon after starting
+CLUSTER_RESTART_MAX_DELAY = 300
+CLUSTER_STABLE_TIME = 300  # Seconds a worker must run for before its restart delay is reset
+CLUSTER_SCRAPE_TIMEOUT = 2